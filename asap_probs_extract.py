@@ -36,51 +36,60 @@ class DistancedHistExtractor:
 
     def has_path(self, src: pairdata.Node, dest: pairdata.Node, typ: str):
         if dest in src.chans_to_pairs:
-            # Go over all paths
-            for i in src.chans_to_pairs[dest].paths.items():
-                if not (i[1].near_field_failed and self.nffilt) or not self.nffilt:
-                    if typ == 'LOS' and i[1].interactions.__len__() == 0 and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'NLOS' and i[1].interactions.__len__() > 0 and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'NLOS-1' and i[1].interactions.__len__() == 1 and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'NLOS-2' and i[1].interactions.__len__() == 2 and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'NLOS-3' and i[1].interactions.__len__() == 3 and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'noLOS' and i[1].interactions.__len__() == 0 and l2db(i[1].pow) >= self.thresh:
-                        return False
-                    elif typ == 'noNLOS' and i[1].interactions.__len__() > 0 and l2db(i[1].pow) >= self.thresh:
-                        return False
-                    elif typ == 'link' and l2db(i[1].pow) >= self.thresh:
-                        return True
-                    elif typ == 'nolink' and l2db(i[1].pow) >= self.thresh:
-                        return False
-                    elif typ == 'any':
-                        return True
-                else:
-                    print('NF test failed, ignoring path {} in chan {}->{}'.format(i[1].pathid, src.node_id,
-                                                                                   dest.node_id))
-                    #pass
+            return self.chan_has_path(src.chans_to_pairs[dest], typ)
         else:
             return False
 
+    def chan_has_path(self, chan: pairdata.chan, typ: str):
+        # Go over all paths
+        for i in chan.paths.items():
+            if not (i[1].near_field_failed and self.nffilt) or not self.nffilt:
+                if typ == 'LOS' and i[1].interactions.__len__() == 0 and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'NLOS' and i[1].interactions.__len__() > 0 and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'NLOS-1' and i[1].interactions.__len__() == 1 and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'NLOS-2' and i[1].interactions.__len__() == 2 and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'NLOS-3' and i[1].interactions.__len__() == 3 and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'noLOS' and i[1].interactions.__len__() == 0 and l2db(i[1].pow) >= self.thresh:
+                    return False
+                elif typ == 'noNLOS' and i[1].interactions.__len__() > 0 and l2db(i[1].pow) >= self.thresh:
+                    return False
+                elif typ == 'link' and l2db(i[1].pow) >= self.thresh:
+                    return True
+                elif typ == 'nolink' and l2db(i[1].pow) >= self.thresh:
+                    return False
+                elif typ == 'any':
+                    return True
+            else:
+                print('NF test failed, ignoring path {} in chan {}->{}'.format(i[1].pathid, chan.src.node_id,
+                                                                               chan.dest.node_id))
+                #pass
+
         if typ in ['LOS', 'NLOS', 'link', 'NLOS-1', 'NLOS-2', 'NLOS-3']:
             return False
         else:
             return True
 
-    def build(self, txgrp: int = -1, rxgrp: int = -1, typ: str = 'LOS'):
+    def build(self, txgrp: int = -1, rxgrp: int = -1, typ: str = 'LOS', stream: bool = False, batch: int = 16,
+              freq: float = 60e9):
         self.type = typ
-        for i in self.source.txs.items():
-            if i[1].setid == txgrp or txgrp == -1:
-                for j in i[1].chans_to_pairs.items():
-                    if j[0].setid == rxgrp or rxgrp == -1:
-                        if self.has_path(i[1], j[0], typ):
-                            self.hist.append_succ(j[1].dist)
-                        else:
-                            self.hist.append_fail(j[1].dist)
+        if stream:
+            # One pass straight from the DB, nothing has to be loaded but the nodes. Streamed channels never went
+            # through check_data_NF, with nffilt the NF test at freq is run on them while streaming.
+            chans = self.source.iter_channels([txgrp], [rxgrp], batch=batch, nff=self.nffilt, freq=freq)
+        else:
+            chans = (j[1] for i in self.source.txs.items() if i[1].setid == txgrp or txgrp == -1
+                     for j in i[1].chans_to_pairs.items() if j[0].setid == rxgrp or rxgrp == -1)
+
+        for j in chans:
+            if self.chan_has_path(j, typ):
+                self.hist.append_succ(j.dist)
+            else:
+                self.hist.append_fail(j.dist)
 
     def build_trans(self, txgrp: int = -1, rxgrp: int = -1, typ: str = 'LOS->LOS'):
         self.type = typ
@@ -164,9 +173,7 @@ class DistancedHistExtractor:
 
 if __name__ == "__main__":
     DS = pairdata.data_stor(conf='dbconf.txt', threaded=True)
-    DS.load_rxtx(dbname='Human_sitting_legsback_Sitting_sqlite')
-    DS.load_paths(npaths=250)
-    DS.load_interactions(store=True)
+    DS.load('Human_sitting_legsback_Sitting_sqlite', npaths=250, store=True)
     #DS.dump_paths(csvsav=True)
 
     from phys_path_procs import *
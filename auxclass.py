@@ -14,6 +14,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
+import os
+import shutil
+import tempfile
 
 
 class VarHist:
@@ -186,4 +189,41 @@ class PowHist2D:
                     self.addfun(i, linpow)
                     self.tothits += 1
                     return True
-        return False
\ No newline at end of file
+        return False
+
+
+class SpillDir:
+    '''Per-chunk partial results kept on disk until every chunk is done, see data_stor.iter_chunks.'''
+    def __init__(self, dirname: str = None):
+        self.dirname = tempfile.mkdtemp(prefix='wispill_', dir=dirname)
+        self.nchunks = 0
+
+    def save(self, **arrays):
+        np.savez(os.path.join(self.dirname, 'chunk{:06d}.npz'.format(self.nchunks)), **arrays)
+        self.nchunks += 1
+
+    def chunks(self):
+        for i in range(self.nchunks):
+            with np.load(os.path.join(self.dirname, 'chunk{:06d}.npz'.format(i))) as file:
+                yield {k: file[k] for k in file.files}
+
+    def concat(self, key: str):
+        # Joined on disk chunk by chunk and returned memory-mapped, never held in memory as a whole
+        parts = [(i[key].shape, i[key].dtype) for i in self.chunks()]
+        if parts.__len__() == 0:
+            return np.zeros([0])
+
+        fname = os.path.join(self.dirname, key + '.npy')
+        out = np.lib.format.open_memmap(fname, mode='w+', dtype=parts[0][1],
+                                        shape=(sum(i[0][0] for i in parts),) + parts[0][0][1:])
+        pos = 0
+        for i in self.chunks():
+            out[pos:pos + i[key].shape[0]] = i[key]
+            pos += i[key].shape[0]
+        out.flush()
+        del out
+        return np.load(fname, mmap_mode='r')
+
+    def close(self):
+        # Mapped arrays from concat stay valid after their file is unlinked on POSIX
+        shutil.rmtree(self.dirname, ignore_errors=True)
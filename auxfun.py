@@ -92,3 +92,29 @@ def l2db(val: float):
 
 def db2l(val: float):
     return np.power(10.0, val / 10.0)
+
+
+def path_lengths(src, dst, coords, ptr):
+    # Lengths of polylines src[i] -> coords[ptr[i]:ptr[i + 1]] -> dst[i] for all i at once
+    src = np.asarray(src, dtype=float).reshape([-1, 3])
+    dst = np.asarray(dst, dtype=float).reshape([-1, 3])
+    coords = np.asarray(coords, dtype=float).reshape([-1, 3])
+    ptr = np.asarray(ptr, dtype=np.int64)
+
+    n = src.shape[0]
+    if n == 0:
+        return np.zeros([0])
+
+    counts = np.diff(ptr)
+    starts = ptr[:-1] + 2 * np.arange(n)
+
+    pts = np.empty([coords.shape[0] + 2 * n, 3])
+    pts[starts] = src
+    pts[starts + counts + 1] = dst
+    pts[np.arange(coords.shape[0]) + 2 * np.repeat(np.arange(n), counts) + 1] = coords
+
+    seg = np.linalg.norm(np.diff(pts, axis=0), axis=1)
+    # Drop the jumps from the end of one path to the start of the next one
+    seg[starts[1:] - 1] = 0.0
+
+    return np.add.reduceat(seg, starts)
@@ -202,9 +202,7 @@ class chimage_TX():
 
 if __name__ == "__main__":
     DS = pairdata.data_stor(conf='dbconf.txt')
-    DS.load_rxtx(dbname='Human_sitting_legsback_Sitting_sqlite')
-    DS.load_paths(npaths=250)
-    DS.load_interactions(store=True)
+    DS.load('Human_sitting_legsback_Sitting_sqlite', npaths=250, store=True, mmap=True, rxgrp=[2, 5, 6])
 
     from phys_path_procs import *
     check_data_NF(DS)
@@ -20,7 +20,7 @@ import scipy.io as sio
 import matplotlib.pyplot as mpl
 import pairdata
 from phys_path_procs import *
-from auxclass import PowHist
+from auxclass import PowHist, SpillDir
 
 class cirs:
     def __init__(self, source):
@@ -50,7 +50,7 @@ class cirs:
     def export(self, txrange: int = -1, rxrange: int = -1, txgrp: int = -1, rxgrp: int = -1, mkpng: bool = False,
                cmap: str = 'Blues', xdim: int = 100, ydim: int = 250, zmin: float = -200.0, zmax: float = np.nan,
                nff: bool = True, matsav: bool = False, plot: bool = True, show: bool =True, fidbase: int = 0,
-               title: str = ''):
+               title: str = '', chunked: bool = False, chunk: int = 16, spill_dir: str = None, freq: float = 60e9):
 
         if txrange == -1:
             txrange = self.source.txs.keys()
@@ -67,87 +67,117 @@ class cirs:
         txgrp = [txgrp] if not isinstance(txgrp, list) else txgrp
         rxgrp = [rxgrp] if not isinstance(rxgrp, list) else rxgrp
 
-        for i in txrange:
-            if self.source.txs[i].setid in txgrp or txgrp[0] == -1:
-                self.xdata = []
-                self.ydata = []
-                self.zdata = []
-
-                self.ydim = ydim
-                self.xdim = 0
-                for j in rxrange:
-                    if self.source.rxs[j].setid in rxgrp or rxgrp[0] == -1:
-                        self.xdim += 1
-                        if self.source.txs[i].chan_to(self.source.rxs[j]) is not None:
-                            for k in self.source.txs[i].chan_to(self.source.rxs[j]).paths.items():
-                                if nff and not k[1].near_field_failed and zmax > l2db(k[1].pow) > zmin:
-                                    self.xdata.append(j)
-                                    self.ydata.append(k[1].delay * 1e9)
-                                    self.zdata.append(l2db(k[1].pow))
-                                elif not nff and zmax > l2db(k[1].pow) > zmin:
-                                    self.xdata.append(j)
-                                    self.ydata.append(k[1].delay * 1e9)
-                                    self.zdata.append(l2db(k[1].pow))
-                        else:
-                            if self.ydata.__len__() > 0:
-                                self.ymax = np.nanmax(self.ydata)
-                                self.xdata.append(j)
-                                self.ydata.append(self.ymax)
-                                self.zdata.append(zmin)
-
-                if np.max(self.ydata) == 0:
-                    self.ydata[-1] = 1e-9
-
-                if np.isnan(np.nanmin(self.zdata)):
-                    for z in range(self.zdata.__len__()):
-                        self.zdata[z] = zmin
-
-                (x, y, z) = basint3(self.xdata, self.ydata, self.zdata, self.xdim, self.ydim, zmin=zmin)
-                [x, y] = np.meshgrid(x, y)
-
-                self.xmax = np.nanmax(self.xdata)
-                self.xmin = np.nanmin(self.xdata)
-
-                self.ymax = np.nanmax(self.ydata)
-                self.ymin = np.nanmin(self.ydata)
-
-                self.tx = i
+        if chunked:
+            # Out of core: CIR grids of one chunk of TXs at a time are spilled, then drawn once all are done.
+            # The chunks never went through check_data_NF, the NF test at freq is run on them as they come.
+            spill = SpillDir(spill_dir)
+            txrange = set(txrange)
+            for chans in self.source.iter_chunks(txgrp, rxgrp, chunk=chunk, nff=nff, freq=freq):
+                index = {(c.src.node_id, c.dest.node_id): c for c in chans}
+                for i in sorted({c.src.node_id for c in chans} & txrange):
+                    (x, y, z) = self._grid(i, rxrange, rxgrp, lambda t, r: index.get((t, r)), xdim, ydim, zmin, zmax,
+                                           nff)
+                    spill.save(tx=i, x=x, y=y, z=z, lims=[self.xmin, self.xmax, self.ymin, self.ymax, self.zmin,
+                                                          self.zmax])
+
+            for k in spill.chunks():
+                [self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax] = k['lims'].tolist()
+                self.tx = int(k['tx'])
                 self.rxgrp = rxgrp[0]
+                self._draw(self.tx, k['x'], k['y'], k['z'], rxgrp, mkpng, cmap, matsav, plot, show, fidbase, title)
+            spill.close()
+        else:
+            for i in txrange:
+                if self.source.txs[i].setid in txgrp or txgrp[0] == -1:
+                    (x, y, z) = self._grid(i, rxrange, rxgrp, self.source.get_chan, xdim, ydim, zmin, zmax, nff)
+                    self.tx = i
+                    self.rxgrp = rxgrp[0]
+                    self._draw(i, x, y, z, rxgrp, mkpng, cmap, matsav, plot, show, fidbase, title)
+
+        if mkpng is False and plot and show:
+            mpl.show()
 
-                if np.isnan(zmax):
-                    self.zmin = np.nanmin(z)
-                    self.zmax = np.nanmax(z) + np.abs(0.1 * np.nanmax(z))
+    def _grid(self, i: int, rxrange, rxgrp: list, get_chan: callable, xdim: int, ydim: int, zmin: float, zmax: float,
+              nff: bool):
+        # Interpolated CIR of TX i over all RXs in range, returns the (x, y, z) grid
+        self.xdata = []
+        self.ydata = []
+        self.zdata = []
+
+        self.ydim = ydim
+        self.xdim = 0
+        for j in rxrange:
+            if self.source.rxs[j].setid in rxgrp or rxgrp[0] == -1:
+                self.xdim += 1
+                c = get_chan(i, j)
+                if c is not None:
+                    for k in c.paths.items():
+                        if nff and not k[1].near_field_failed and zmax > l2db(k[1].pow) > zmin:
+                            self.xdata.append(j)
+                            self.ydata.append(k[1].delay * 1e9)
+                            self.zdata.append(l2db(k[1].pow))
+                        elif not nff and zmax > l2db(k[1].pow) > zmin:
+                            self.xdata.append(j)
+                            self.ydata.append(k[1].delay * 1e9)
+                            self.zdata.append(l2db(k[1].pow))
                 else:
-                    self.zmin = zmin
-                    self.zmax = zmax
+                    if self.ydata.__len__() > 0:
+                        self.ymax = np.nanmax(self.ydata)
+                        self.xdata.append(j)
+                        self.ydata.append(self.ymax)
+                        self.zdata.append(zmin)
 
-                if plot or mkpng:
-                    f = mpl.figure(fidbase + i)
+        if np.max(self.ydata) == 0:
+            self.ydata[-1] = 1e-9
 
-                    mpl.pcolor(np.transpose(x), np.transpose(y), z, cmap=cmap, vmin=self.zmin, vmax=self.zmax)
+        if np.isnan(np.nanmin(self.zdata)):
+            for z in range(self.zdata.__len__()):
+                self.zdata[z] = zmin
 
-                    cb = mpl.colorbar(ticks=np.linspace(start=self.zmin, stop=self.zmax, num=11, endpoint=True).tolist())
-                    cb.set_label('RX power, [dBm]')
-                    cb.set_clim(vmin=self.zmin, vmax=self.zmax)
-                    mpl.clim(vmin=self.zmin, vmax=self.zmax)
+        (x, y, z) = basint3(self.xdata, self.ydata, self.zdata, self.xdim, self.ydim, zmin=zmin)
+        [x, y] = np.meshgrid(x, y)
 
-                    mpl.xlabel('RX Position')
-                    mpl.ylabel('Delay, [ns]')
-                    mpl.title('{}CIR\@TX \#{}'.format(title, i))
-                    mpl.tight_layout()
+        self.xmax = np.nanmax(self.xdata)
+        self.xmin = np.nanmin(self.xdata)
 
-                if mkpng:
-                    mpl.savefig('{2}CIR3D_tx{0:03d}_rxgrp{1:03d}.png'.format(i, rxgrp[0], title))
-                    mpl.close(f)
+        self.ymax = np.nanmax(self.ydata)
+        self.ymin = np.nanmin(self.ydata)
 
-                if matsav:
-                    sio.savemat('{2}CIR3D_tx{0:03d}_rxgrp{1:03d}.mat'.format(i, rxgrp[0], title), {'X': x, 'Y': y, 'Z': z})
+        if np.isnan(zmax):
+            self.zmin = np.nanmin(z)
+            self.zmax = np.nanmax(z) + np.abs(0.1 * np.nanmax(z))
+        else:
+            self.zmin = zmin
+            self.zmax = zmax
 
-                if not mkpng and (not plot or not show):
-                    mpl.close(f)
+        return x, y, z
 
-        if mkpng is False and plot and show:
-            mpl.show()
+    def _draw(self, i: int, x, y, z, rxgrp: list, mkpng: bool, cmap: str, matsav: bool, plot: bool, show: bool,
+              fidbase: int, title: str):
+        if plot or mkpng:
+            f = mpl.figure(fidbase + i)
+
+            mpl.pcolor(np.transpose(x), np.transpose(y), z, cmap=cmap, vmin=self.zmin, vmax=self.zmax)
+
+            cb = mpl.colorbar(ticks=np.linspace(start=self.zmin, stop=self.zmax, num=11, endpoint=True).tolist())
+            cb.set_label('RX power, [dBm]')
+            cb.set_clim(vmin=self.zmin, vmax=self.zmax)
+            mpl.clim(vmin=self.zmin, vmax=self.zmax)
+
+            mpl.xlabel('RX Position')
+            mpl.ylabel('Delay, [ns]')
+            mpl.title('{}CIR\@TX \#{}'.format(title, i))
+            mpl.tight_layout()
+
+        if mkpng:
+            mpl.savefig('{2}CIR3D_tx{0:03d}_rxgrp{1:03d}.png'.format(i, rxgrp[0], title))
+            mpl.close(f)
+
+        if matsav:
+            sio.savemat('{2}CIR3D_tx{0:03d}_rxgrp{1:03d}.mat'.format(i, rxgrp[0], title), {'X': x, 'Y': y, 'Z': z})
+
+        if not mkpng and (not plot or not show):
+            mpl.close(f)
 
     def export_pdp(self, tx: list = [-1], rx: list = [-1], nff: bool = True, avg: bool = False, floor: float = -110.0,
                    matsav: bool = False, csvsav: bool = False, plot: bool = True, mkpng: bool = False,
@@ -180,8 +210,9 @@ class cirs:
                     delay = []
                     pow = []
 
-                if self.source.txs[i].chan_to(self.source.rxs[j]):
-                    for k in self.source.txs[i].chans_to_pairs[self.source.rxs[j]].paths.items():
+                c = self.source.get_chan(i, j)
+                if c is not None:
+                    for k in c.paths.items():
                         if ceil > l2db(k[1].pow) > floor:
                             if nff and not k[1].near_field_failed:
                                 delay.append(k[1].delay)
@@ -269,8 +300,9 @@ class cirs:
                 delay = list()
                 power = list()
 
-                if self.source.txs[i].chan_to(self.source.rxs[j]):
-                    for k in self.source.txs[i].chans_to_pairs[self.source.rxs[j]].paths.items():
+                c = self.source.get_chan(i, j)
+                if c is not None:
+                    for k in c.paths.items():
                         if ceil > l2db(k[1].pow) > floor:
                             if nff and not k[1].near_field_failed:
                                 delay.append(k[1].delay)
@@ -338,9 +370,7 @@ class cirs:
 
 if __name__ == "__main__":
     DS = pairdata.data_stor('dbconf.txt')
-    DS.load_rxtx('Human_sitting_legsback_Sitting_fleece_sqlite')
-    DS.load_paths(npaths=250)
-    DS.load_interactions(store=True)
+    DS.load('Human_sitting_legsback_Sitting_fleece_sqlite', npaths=250, store=True, mmap=True, rxgrp=[2, 4, 5, 6])
     #check_data_NF(DS)
     cir = cirs(DS)
     cir.export(txgrp=-1, rxgrp=6, nff=True, matsav=False, plot=True, mkpng=False, zmin=-190.0, zmax=-40.0)
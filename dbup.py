@@ -19,12 +19,21 @@ import mysql.connector as msc
 from mysql.connector.constants import ClientFlag
 import sqlite3
 import concurrent.futures as cof
+import threading
+import queue
 from multiprocessing import cpu_count
 from time import sleep
-from sys import argv
-
-max_waiting = 5 * cpu_count()
-stepping = 1e3
+import argparse
+import os
+import tempfile
+
+# Long-lived writer connections, each holds up to depth batches waiting in the queue
+writers = 2 * cpu_count()
+depth = 2
+# A batch failing with a server error is retried on a fresh connection this many times
+retries = 2
+# Rows per batch, LOAD DATA files are cheap to make much larger than a parameterised INSERT
+stepping = {'executemany': 5000, 'infile': 100000}
 
 WI_TABLES = {'path': [('path_id', 'INT PRIMARY KEY'), ('channel_id', 'INT'), ('foliage_distance', 'REAL')],
              'path_utd': [('path_id', 'INT'), ('path_utd_id', 'INT PRIMARY KEY'), ('tx_sub_antenna', 'INT'), ('rx_sub_antenna', 'INT'),
@@ -51,130 +60,343 @@ WI_TABLES = {'path': [('path_id', 'INT PRIMARY KEY'), ('channel_id', 'INT'), ('f
              'utd_instance_param': [('utd_instance_id', 'INT NOT NULL'), ('utd_instance_param_id', 'INT NOT NULL'), ('element_id', 'INT NOT NULL'), ('parameter', 'REAL')],
              'scene_origin': [('latitude', 'REAL'), ('longitude', 'REAL'), ('altitude', 'REAL')]}
 
-conf = open('dbconf.txt')
-
-host = conf.readline()
-user = conf.readline()
-pw = conf.readline()
-
-conf.close()
-
-sqlconn = msc.connect(host=host.strip('\n'), user=user.strip('\n'), password=pw.strip('\n'), client_flags=[ClientFlag.SSL])
-sqlcurs = sqlconn.cursor()
-
-
-
-if argv.__len__() == 1:
-    dbf = input('Type in DB path: ')
-    dbn = input('Type in database name: ')
-else:
-    dbf = ' '.join(argv[1:argv.__len__()]).strip('"').strip("'")
-    dbn = dbf.split('\\')[-1]
-
-dbn = dbn.replace('.', '_').replace('@','at').replace(' ', '_')
-
-
-
-sqlcurs.execute('CREATE DATABASE {};'.format(dbn))
-sqlcurs.execute('USE {};'.format(dbn))
-
-# Create table on MySQL server
-for i in WI_TABLES.items():
-    # Compile request
-    if i[0] in ['path', 'path_utd', 'channel', 'channel_utd', 'rx', 'tx', 'diffraction_edge', 'interaction', 'rx_set',
-                'rx_metadata', 'tx_metadata', 'txrx_set_type', 'utd_instance', 'utd_instance_param', 'scene_origin']:
-        rstr = 'CREATE TABLE {}('.format(i[0])
+UP_TABLES = ['path', 'path_utd', 'channel', 'channel_utd', 'rx', 'tx', 'diffraction_edge', 'interaction',
+             'interaction_type', 'rx_set', 'rx_metadata', 'tx_metadata', 'txrx_set_type', 'utd_instance',
+             'utd_instance_param', 'scene_origin']
+
+# Columns the queries of siso_sql.py read, plus primary keys. Only these are uploaded with the 'analysis' profile.
+ANALYSIS_COLS = {'path': ['path_id', 'channel_id'],
+                 'path_utd': ['path_id', 'path_utd_id', 'received_power', 'time_of_arrival', 'departure_phi',
+                              'departure_theta', 'arrival_phi', 'arrival_theta', 'freespace_path_loss', 'cir_phs'],
+                 'channel': ['channel_id', 'tx_id', 'rx_id'],
+                 'channel_utd': ['channel_utd_id', 'channel_id', 'received_power', 'mean_time_of_arrival',
+                                 'delay_spread'],
+                 'rx': ['rx_id', 'rx_set_id', 'x', 'y', 'z'],
+                 'tx': ['tx_id', 'tx_set_id', 'x', 'y', 'z'],
+                 'interaction': ['interaction_id', 'path_id', 'interaction_type_id', 'x', 'y', 'z'],
+                 'interaction_type': ['interaction_type_id', 'description']}
+
+# Secondary indexes, built once all rows are in. path_utd(path_id, received_power) covers the joins, power
+# thresholds and strongest-first ordering of the loader queries in siso_sql.py, channel(rx_id, tx_id) the RX batches.
+WI_INDEXES = {'channel': [('channel_tx_rx_index', 'tx_id,rx_id'), ('channel_rx_tx_index', 'rx_id,tx_id')],
+              'channel_utd': [('channel_utd_channel_index', 'channel_id')],
+              'interaction': [('interaction_path_index', 'path_id')],
+              'path': [('path_channel_index', 'channel_id')],
+              'path_utd': [('path_utd_path_pow_index', 'path_id,received_power')]}
+
+def schema(profile='full'):
+    # Table -> [(column, type)] to create and upload
+    if profile == 'full':
+        return {i: WI_TABLES[i] for i in WI_TABLES.keys() if i in UP_TABLES}
+    return {i: [j for j in WI_TABLES[i] if j[0] in ANALYSIS_COLS[i]] for i in WI_TABLES.keys() if i in ANALYSIS_COLS}
+
+
+# Uploaded chunks as SQLite rowid spans (after_row, last_row], written in the same transaction as their rows
+PROGRESS = 'CREATE TABLE IF NOT EXISTS dbup_progress(table_name VARCHAR(64), after_row BIGINT, last_row BIGINT);'
+# SQLite file the checkpoints belong to, rowids of a re-simulated study mean nothing to them
+SOURCE = 'CREATE TABLE IF NOT EXISTS dbup_source(path VARCHAR(1024), size BIGINT, mtime DOUBLE);'
+FIRST_ROW = -2 ** 63
+
+
+def connect(host, user, pw, dbn=None, infile=False):
+    return msc.connect(host=host, user=user, password=pw, database=dbn, client_flags=[ClientFlag.SSL],
+                       allow_local_infile=infile)
+
+
+def tune(curs):
+    # Bulk upload session: nothing is committed or checked row by row, indexes come afterwards
+    curs.execute('SET autocommit = 0;')
+    curs.execute('SET unique_checks = 0;')
+    curs.execute('SET foreign_key_checks = 0;')
+
+
+def checkpoint(curs, table, span):
+    curs.execute('INSERT INTO dbup_progress VALUES (%s, %s, %s);', (table, span[0], span[1]))
+
+
+def sqlins(curs, table, cols, rows):
+    # One parameterised multi-row INSERT, values keep their SQLite types and NULLs
+    curs.executemany('INSERT INTO {} ({}) VALUES ({});'.format(table, ','.join(cols), ','.join(['%s'] * cols.__len__())),
+                     rows)
+
+
+def tsv_field(val):
+    if val is None:
+        return '\\N'
+    if isinstance(val, float):
+        # repr is the shortest string that reads back to the same double
+        return repr(val)
+    if isinstance(val, bytes):
+        val = val.decode()
+    return str(val).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def sqlload(curs, table, cols, rows):
+    # Rows go through a local TSV file and LOAD DATA LOCAL INFILE, the fastest bulk path of the server
+    fd, fname = tempfile.mkstemp(prefix='dbup_', suffix='.tsv')
+    try:
+        with os.fdopen(fd, mode='w', newline='\n', encoding='utf-8') as file:
+            for i in rows:
+                file.write('\t'.join(tsv_field(j) for j in i) + '\n')
+
+        curs.execute("LOAD DATA LOCAL INFILE '{}' INTO TABLE {} CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' "
+                     "ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({});".format(fname.replace('\\', '/'), table,
+                                                                              ','.join(cols)))
+    finally:
+        os.remove(fname)
+
+
+def source_id(dbf):
+    st = os.stat(dbf)
+    return os.path.abspath(dbf), st.st_size, st.st_mtime
+
+
+def check_source(sqlcurs, dbn, tables, dbf):
+    # Only an upload of the very same file may resume, anything else would keep stale rows without a word
+    sqlcurs.execute('SELECT path, size, mtime FROM dbup_source;')
+    rows = sqlcurs.fetchall()
+    if rows.__len__() > 0:
+        if tuple(rows[0]) != source_id(dbf):
+            raise RuntimeError('Database {} holds an upload of {} (size {}, mtime {}), which is not {} as it is now. '
+                               'Pass --restart to upload it from scratch.'.format(dbn, *rows[0], dbf))
+        return
+
+    for i in list(tables.keys()) + ['dbup_progress']:
+        sqlcurs.execute('SELECT 1 FROM {} LIMIT 1;'.format(i))
+        if sqlcurs.fetchall().__len__() > 0:
+            raise RuntimeError('Database {} already holds rows of {} from an unknown source. Pass --restart to upload '
+                               '{} from scratch.'.format(dbn, i, dbf))
+    sqlcurs.execute('INSERT INTO dbup_source VALUES (%s, %s, %s);', source_id(dbf))
+    sqlcurs.execute('COMMIT;')
+
+
+def create_tables(sqlcurs, dbn, tables, dbf, restart=False):
+    # Existing tables are kept, an interrupted upload of the same dbf resumes where dbup_progress says it stopped
+    if restart:
+        sqlcurs.execute('DROP DATABASE IF EXISTS {};'.format(dbn))
+    sqlcurs.execute('CREATE DATABASE IF NOT EXISTS {};'.format(dbn))
+    sqlcurs.execute('USE {};'.format(dbn))
+    sqlcurs.execute(PROGRESS)
+    sqlcurs.execute(SOURCE)
+
+    # Create table on MySQL server
+    for i in tables.items():
+        # Compile request
+        rstr = 'CREATE TABLE IF NOT EXISTS {}('.format(i[0])
         for j in i[1]:
             rstr = rstr + j[0] + ' ' + j[1] + (',\n' if i[1][-1] != j else '\n')
 
         rstr = rstr + ');'
         sqlcurs.execute(rstr)
 
-print(dbf)
-sleep(5)
+    check_source(sqlcurs, dbn, tables, dbf)
 
-sqlicon = sqlite3.connect(dbf)
-sqlicon.row_factory = sqlite3.Row
-sqlicurs = sqlicon.cursor()
 
-waiting = 0
-
-
-def sqlins(dbn, data, host, user, pw):
-    global waiting
-    waiting += 1
-    conn = msc.connect(host=host.strip('\n'), user=user.strip('\n'), password=pw.strip('\n'))
+def add_indexes(dbn, table, host, user, pw):
+    # All missing indexes of a table in one ALTER, so the table is scanned once
+    conn = connect(host, user, pw, dbn)
     curs = conn.cursor()
-    curs.execute('USE {};'.format(dbn))
-    curs.execute(data)
-    conn.commit()
+    curs.execute('SELECT DISTINCT index_name FROM information_schema.statistics WHERE table_schema = %s AND '
+                 'table_name = %s;', (dbn, table))
+    # Built by an earlier run of a resumed upload
+    have = [i[0] for i in curs.fetchall()]
+    todo = [i for i in WI_INDEXES[table] if i[0] not in have]
+    if todo.__len__() > 0:
+        print('Indexing {}'.format(table))
+        curs.execute('ALTER TABLE {} {};'.format(table, ', '.join('ADD INDEX {} ({})'.format(*i) for i in todo)))
+        print('Finished indexing {}'.format(table))
     conn.close()
-    waiting -= 1
-
-
-TPE = cof.ThreadPoolExecutor(max_workers=max_waiting)
-
-for i in WI_TABLES.items():
-    if i[0] in ['path', 'path_utd', 'channel', 'channel_utd', 'rx', 'tx', 'diffraction_edge', 'interaction', 'rx_set',
-                'rx_metadata', 'tx_metadata', 'txrx_set_type', 'utd_instance', 'utd_instance_param', 'scene_origin']:
-        # Construct request
-        req = "SELECT "
-        for j in i[1]:
-            req = req + j[0] + (', ' if i[1][-1] != j else ' FROM {}'.format(i[0]))
-
-        comm = 0
-
-        key_prep = False
-
-        print('Writing {}'.format(i[0]))
-
-        for j in sqlicurs.execute(req):
-            if comm % stepping == 0:
-                myreq = ["INSERT INTO {} ".format(i[0])]
-                myreq.append('(')
-                myreq.append(','.join(j.keys()))
-                myreq.append(') VALUES ')
-
-            myreq.append('(')
-
-            te = 1
-            for k in j.keys():
-                myreq.append(str(j[k]))
-                myreq.append((',' if te < j.keys().__len__() else ')'))
-                te += 1
-
-            if (comm + 1) % stepping == 0:
-                myreq.append(';')
-                # Avoid excessive memory consumption
-                while waiting >= max_waiting:
-                    sleep(0.1)
-
-                TPE.submit(sqlins, dbn, ''.join(myreq), host, user, pw)
-                print('Writing to {} at row {}'.format(i[0], comm))
-            else:
-                myreq.append(',')
-
-            comm += 1
-
-        if (comm + 1) % stepping != 0:
-            myreq[-1] = ';'
-            while waiting >= max_waiting:
-                sleep(0.1)
-            TPE.submit(sqlins, dbn, ''.join(myreq), host, user, pw)
-            print('Writing to {} at row {}'.format(i[0], comm))
-
-        print('Finished writing {}'.format(i[0]))
-
-TPE.shutdown(wait=True)
 
-sqlcurs.execute('CREATE INDEX channel_tx_rx_index ON channel(tx_id,rx_id);')
-sqlcurs.execute('CREATE INDEX channel_utd_channel_index ON channel_utd(channel_id);')
-sqlcurs.execute('CREATE INDEX interaction_path_index ON interaction(path_id);')
-sqlcurs.execute('CREATE INDEX path_channel_index ON path(channel_id);')
-sqlcurs.execute('CREATE INDEX path_utd_path_index ON path_utd(path_id);')
 
-sqlconn.commit()
-sqlconn.close()
-print('ALL DONE, CONNECTIONS TERMINATED')
-input('')
-exit()
\ No newline at end of file
+def build_indexes(dbn, tables, host, user, pw):
+    # Tables are indexed concurrently on their own connections, indexes of one table would only wait for each other
+    with cof.ThreadPoolExecutor(max_workers=WI_INDEXES.__len__()) as TPE:
+        futs = [TPE.submit(add_indexes, dbn, i, host, user, pw) for i in WI_INDEXES.keys() if i in tables]
+    for i in futs:
+        i.result()
+
+
+def uploaded(sqlcurs, table):
+    # Merged spans of rows already on the server
+    sqlcurs.execute('SELECT after_row, last_row FROM dbup_progress WHERE table_name = %s ORDER BY after_row;', (table,))
+    spans = []
+    for i in sqlcurs.fetchall():
+        if spans.__len__() > 0 and i[0] <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], i[1])
+        else:
+            spans.append([i[0], i[1]])
+    return spans
+
+
+def writer(jobs, stop, errors, dbn, host, user, pw, mode):
+    # Consumes batches on one connection until it gets None, a batch and its checkpoint are committed together
+    ins = sqlins if mode == 'executemany' else sqlload
+    conn = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        tries = 0
+        while not stop.is_set():
+            try:
+                if conn is None:
+                    conn = connect(host, user, pw, dbn, infile=mode == 'infile')
+                    tune(conn.cursor())
+                curs = conn.cursor()
+                ins(curs, job[0], job[1], job[2])
+                checkpoint(curs, job[0], job[3])
+                conn.commit()
+                break
+            except Exception as e:
+                # Nothing of the batch is committed, try again on a fresh connection
+                try:
+                    if conn is not None:
+                        conn.close()
+                except msc.Error:
+                    pass
+                conn = None
+                if not isinstance(e, msc.Error) or tries >= retries:
+                    # Readers stop too, a rerun resumes from the last checkpoint
+                    errors.append(e)
+                    stop.set()
+                    break
+                tries += 1
+                print('Batch of {} failed ({}), retrying...'.format(job[0], e))
+
+    if conn is not None:
+        conn.close()
+
+
+def read_table(sqlicurs, table, cols, spans, batch, jobs, stop):
+    # Rows are read in rowid order, skipping everything a previous run already uploaded
+    resumed = spans.__len__() > 0
+    after = FIRST_ROW
+    if resumed and spans[0][0] == FIRST_ROW:
+        after = spans.pop(0)[1]
+    req = 'SELECT rowid, {} FROM {} WHERE rowid > ?'.format(', '.join(cols), table)
+    req += ''.join(' AND NOT (rowid > ? AND rowid <= ?)' for j in spans)
+    sqlicurs.execute(req + ' ORDER BY rowid', [after] + [k for j in spans for k in j])
+
+    comm = 0
+    while not stop.is_set():
+        rows = sqlicurs.fetchmany(batch)
+        if rows.__len__() == 0:
+            break
+        if comm == 0:
+            print('Writing {}{}'.format(table, ', resuming' if resumed else ''))
+
+        span = (after, rows[-1][0])
+        after = rows[-1][0]
+        # Blocks while the writers are behind, which bounds memory
+        jobs.put((table, cols, [j[1:] for j in rows], span))
+        comm += rows.__len__()
+        print('Writing to {} at row {}'.format(table, comm))
+
+    print('Skipping {}, already uploaded'.format(table) if resumed and comm == 0 else
+          'Finished reading {}'.format(table))
+
+
+def reader(dbf, tables, spans, batch, jobs, stop, errors):
+    # SQLite connections stay in the thread that made them
+    sqlicon = sqlite3.connect(dbf)
+    try:
+        while not stop.is_set():
+            try:
+                table, cols = tables.get_nowait()
+            except queue.Empty:
+                break
+            read_table(sqlicon.cursor(), table, cols, spans[table], batch, jobs, stop)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        sqlicon.close()
+
+
+def upload(dbf, sqlcurs, dbn, tables, host, user, pw, mode='executemany', batch=None, nwriters=None, ntables=1):
+    # ntables readers pull whole tables from SQLite into one bounded queue, nwriters connections drain it
+    batch = stepping[mode] if batch is None else batch
+    nwriters = writers if nwriters is None else nwriters
+
+    todo = queue.Queue()
+    spans = dict()
+    for i in tables.items():
+        todo.put((i[0], [j[0] for j in i[1]]))
+        spans[i[0]] = uploaded(sqlcurs, i[0])
+
+    jobs = queue.Queue(maxsize=depth * nwriters)
+    stop = threading.Event()
+    errors = []
+    wthreads = [threading.Thread(target=writer, args=(jobs, stop, errors, dbn, host, user, pw, mode))
+                for i in range(nwriters)]
+    rthreads = [threading.Thread(target=reader, args=(dbf, todo, spans, batch, jobs, stop, errors))
+                for i in range(ntables)]
+    for i in wthreads + rthreads:
+        i.start()
+
+    for i in rthreads:
+        i.join()
+    for i in wthreads:
+        jobs.put(None)
+    for i in wthreads:
+        i.join()
+
+    # Surface failed batches instead of silently losing rows
+    if errors.__len__() > 0:
+        raise errors[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Uploads a Wireless InSite SQLite study to the MySQL server in '
+                                                 'dbconf.txt')
+    parser.add_argument('dbf', nargs='*', help='SQLite file of the study, asked for when left out')
+    parser.add_argument('--mode', choices=['executemany', 'infile'], default='executemany',
+                        help='parameterised INSERT batches or TSV files through LOAD DATA LOCAL INFILE')
+    parser.add_argument('--batch', type=int, default=None,
+                        help='rows per batch (default {executemany} or {infile})'.format(**stepping))
+    parser.add_argument('--profile', choices=['full', 'analysis'], default='full',
+                        help='every table and column, or only what the pairdata loaders read')
+    parser.add_argument('--restart', action='store_true',
+                        help='drop the database and upload from scratch instead of resuming')
+    parser.add_argument('--writers', type=int, default=writers,
+                        help='writer connections to the server (default {})'.format(writers))
+    parser.add_argument('--tables', type=int, default=1, help='tables read and uploaded at once (default 1)')
+    args = parser.parse_args()
+
+    conf = open('dbconf.txt')
+
+    host = conf.readline().strip('\n')
+    user = conf.readline().strip('\n')
+    pw = conf.readline().strip('\n')
+
+    conf.close()
+
+    sqlconn = connect(host, user, pw)
+    sqlcurs = sqlconn.cursor()
+
+    if args.dbf.__len__() == 0:
+        dbf = input('Type in DB path: ')
+        dbn = input('Type in database name: ')
+    else:
+        dbf = ' '.join(args.dbf).strip('"').strip("'")
+        dbn = dbf.split('\\')[-1]
+
+    dbn = dbn.replace('.', '_').replace('@', 'at').replace(' ', '_')
+
+    tables = schema(args.profile)
+    create_tables(sqlcurs, dbn, tables, dbf, restart=args.restart)
+
+    print(dbf)
+    sleep(5)
+
+    upload(dbf, sqlcurs, dbn, tables, host, user, pw, mode=args.mode, batch=args.batch, nwriters=args.writers,
+           ntables=args.tables)
+
+    build_indexes(dbn, tables, host, user, pw)
+
+    sqlconn.commit()
+    sqlconn.close()
+    print('ALL DONE, CONNECTIONS TERMINATED')
+    input('')
+    exit()
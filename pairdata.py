@@ -16,25 +16,37 @@
 import sqlite3
 import mysql.connector as msqlc
 from mysql.connector.constants import ClientFlag
+from mysql.connector import pooling
 import os
+import hashlib
+from pathlib import Path
 from numpy.linalg import norm
 from numpy import asarray
 from numpy import zeros
+from numpy import argsort, searchsorted, concatenate, cumsum, repeat, arange
+from numpy import lexsort, int64, ndarray
 import concurrent.futures as cof
+from multiprocessing import shared_memory, resource_tracker
+import threading
 from multiprocessing import cpu_count
 import scipy.io as sio
 from siso_sql import *
-from auxfun import l2db
+from auxfun import l2db, db2l, path_lengths
+from pathstore import path_store
 
 
 __author__ = 'Aleksei Ponomarenko-Timofeev'
 
 
 class Node():
+    __slots__ = ('chans_to_pairs', 'node_id', 'coords', 'row', 'rot', 'setid', 'type', 'txpow', 'rxpow')
+
     def __init__(self, typ: str):
         self.chans_to_pairs = dict()
         self.node_id = 0
         self.coords = zeros([3])
+        # Row of coords in data_stor.tx_coords/rx_coords
+        self.row = -1
         self.rot = zeros([3])
         self.setid = 0
         self.type = typ
@@ -45,18 +57,14 @@ class Node():
             self.rxpow = 0.0
 
     def chan_to(self, dest):
-        if self.type == 'TX':
-            for i in self.chans_to_pairs.keys():
-                if self.chans_to_pairs[i].dest == dest:
-                    return self.chans_to_pairs[i]
-        else:
-            for i in self.chans_to_pairs.keys():
-                if self.chans_to_pairs[i].src == dest:
-                    return self.chans_to_pairs[i]
-        return None
+        # Channels are keyed by the node on the other end
+        return self.chans_to_pairs.get(dest)
 
 
 class chan():
+    # valid_pow is set by phys_path_procs.check_chan_NF
+    __slots__ = ('paths', 'dest', 'src', 'pow', 'delay', 'ds', 'dist', 'chid', 'clusters', 'valid_pow')
+
     def __init__(self, dest: Node = None, src: Node = None):
         self.paths = dict()
         self.dest = dest
@@ -78,6 +86,9 @@ class chan():
 
 
 class path():
+    __slots__ = ('pathid', 'pow', 'phase', 'delay', 'len', 'interactions', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length',
+                 'chan', 'cluster', 'near_field_failed')
+
     def __init__(self):
         self.pathid = 0
         self.pow = 0.0
@@ -104,11 +115,24 @@ class path():
 
 
 class interaction():
+    # Coordinates are kept as three floats, an array per hop costs several times more
+    __slots__ = ('typ', 'x', 'y', 'z', 'path')
+
     def __init__(self):
         self.typ = 'TX'
-        self.coords = zeros([3])
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
         self.path = None
 
+    @property
+    def coords(self):
+        return asarray([self.x, self.y, self.z])
+
+    @coords.setter
+    def coords(self, val):
+        self.x, self.y, self.z = val
+
     def __repr__(self):
         print('Interaction')
 
@@ -116,157 +140,251 @@ class interaction():
         print('{}@{}'.format(self.typ, self.coords))
 
 
-def _load_paths_txthread(self, txsids, host, user, pw, dbname):
-    dbconn = msqlc.connect(host=host, user=user, password=pw,
-                                client_flags=[ClientFlag.SSL], database=dbname)
-
-    dbcurs = dbconn.cursor()
-    dbcurs.execute(TX_PAIRST.format(min(txsids), max(txsids), min(txsids), max(txsids)))
-    txp = dbcurs.fetchall()
-
-    for i in txp:
-        dst = self.rxs[i[-2]]
-        self.txs[i[-1]].chans_to_pairs[dst] = chan(dest=dst, src=self.txs[i[-1]])
-        self.rxs[i[-2]].chans_to_pairs[self.txs[i]] = self.txs[i[-1]].chans_to_pairs[dst]
-        self.txs[i[-1]].chans_to_pairs[dst].pow = i[1] * 1e3
-        self.txs[i[-1]].chans_to_pairs[dst].delay = i[2]
-        self.txs[i[-1]].chans_to_pairs[dst].ds = i[3]
-        self.txs[i[-1]].chans_to_pairs[dst].dist = norm(self.txs[i].coords - self.rxs[i[-2]].coords)
-        self.txs[i[-1]].chans_to_pairs[dst].chid = i[0]
-
-    for i in txsids:
-        for j in self.txs[i].chans_to_pairs.keys():
-            dbcurs.execute(CHAN_PTH.format(self.txs[i].chans_to_pairs[j].chid))
-            d = dbcurs.fetchall()
-            d = sorted(d, key=lambda t: t[1], reverse=True)
-            for k in d[0:(self.npaths if d.__len__() >= self.npaths else d.__len__())]:
-                self.txs[i].chans_to_pairs[j].paths[k[0]] = path()
-                self.txs[i].chans_to_pairs[j].paths[k[0]].chan = self.txs[i].chans_to_pairs[j]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].pathid = k[0]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].pow = k[1] * 1e3
-                self.txs[i].chans_to_pairs[j].paths[k[0]].FSPL = k[7]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].phase = k[8]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].delay = k[2]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].AoD = k[3]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].EoD = k[4]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].AoA = k[5]
-                self.txs[i].chans_to_pairs[j].paths[k[0]].EoA = k[6]
-    dbconn.close()
-
-
-def _load_paths_rxthread(self, rxsids, host, user, pw, dbname):
-    dbconn = msqlc.connect(host=host, user=user, password=pw,
-                                client_flags=[ClientFlag.SSL], database=dbname)
-
-    dbcurs = dbconn.cursor()
-    dbcurs.execute(RX_PAIRST.format(min(rxsids), max(rxsids), min(rxsids), max(rxsids)))
-    rxp = dbcurs.fetchall()
-
-    for i in rxp:
-        dst = self.rxs[i[-1]]
-        dst.chans_to_pairs[self.txs[i[-2]]] = chan(src=self.txs[i[-2]], dest=dst)
-        self.txs[i[-2]].chans_to_pairs[dst] = dst.chans_to_pairs[self.txs[i[-2]]]
-        dst.chans_to_pairs[self.txs[i[-2]]].pow = i[1] * 1e3
-        dst.chans_to_pairs[self.txs[i[-2]]].delay = i[2]
-        dst.chans_to_pairs[self.txs[i[-2]]].ds = i[3]
-        dst.chans_to_pairs[self.txs[i[-2]]].dist = norm(dst.coords - self.txs[i[-2]].coords)
-        dst.chans_to_pairs[self.txs[i[-2]]].chid = i[0]
-
-    for i in rxsids:
-        for j in self.rxs[i].chans_to_pairs.keys():
-            dbcurs.execute(CHAN_PTH.format(self.rxs[i].chans_to_pairs[j].chid))
-            d = dbcurs.fetchall()
-            d = sorted(d, key=lambda t: t[1], reverse=True)
-            for k in d[0:(self.npaths if d.__len__() >= self.npaths else d.__len__())]:
-                self.rxs[i].chans_to_pairs[j].paths[k[0]] = path()
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].chan = self.rxs[i].chans_to_pairs[j]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].pathid = k[0]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].pow = k[1] * 1e3
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].FSPL = k[7]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].phase = k[8]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].delay = k[2]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].AoD = k[3]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].EoD = k[4]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].AoA = k[5]
-                self.rxs[i].chans_to_pairs[j].paths[k[0]].EoA = k[6]
-
-    dbconn.close()
-
-def _load_iters_txs(self, txsids, host, user, pw, dbname, store):
-    dbconn = msqlc.connect(host=host, user=user, password=pw,
-                                client_flags=[ClientFlag.SSL], database=dbname)
-    dbcurs = dbconn.cursor()
-
-    for i in txsids:
-        for j in self.txs[i].chans_to_pairs.items():
-            dbcurs.execute(INTERS_SPEC_CHAN.format(j[1].chid))
-            inters = dbcurs.fetchall()
-
-            for k in j[1].paths.items():
-                dists = []
-                precoords = j[1].src.coords
-                for l in inters:
-                    if l[4] == k[1].pathid:
-                        if store:
-                            intr = interaction()
-                            intr.path = k[1]
-                            intr.coords = asarray([l[0], l[1], l[2]])
-                            intr.typ = l[3]
-                            dists.append(norm(precoords - intr.coords))
-                            precoords = intr.coords
-                        else:
-                            intr = False
-                        k[1].interactions.append(intr)
-                dists.append(norm(precoords - j[1].dest.coords))
-                k[1].length = sum(dists)
-
-    dbconn.close()
-
-
-def _load_iters_rxs(self, rxsids, host, user, pw, dbname, store):
-    dbconn = msqlc.connect(host=host, user=user, password=pw,
-                           client_flags=[ClientFlag.SSL], database=dbname)
-    dbcurs = dbconn.cursor()
-
-    for i in rxsids:
-        #print(i)
-        for j in self.rxs[i].chans_to_pairs.items():
-            dbcurs.execute(INTERS_SPEC_CHAN.format(j[1].chid))
-            inters = dbcurs.fetchall()
-            #print(j[1].chid, j[1].paths.__len__())
-            for k in j[1].paths.items():
-                dists = []
-                #print(k[1].pathid, inters.__len__())
-                precoords = j[1].src.coords
-                for l in inters:
-                    if l[4] == k[1].pathid:
-                        if store:
-                            intr = interaction()
-                            intr.path = k[1]
-                            intr.coords = asarray([l[0], l[1], l[2]])
-                            intr.typ = l[3]
-                            dists.append(norm(precoords - intr.coords))
-                            precoords = intr.coords
-                        else:
-                            intr = False
-                        k[1].interactions.append(intr)
-                dists.append(norm(precoords - j[1].dest.coords))
-                k[1].length = sum(dists)
+class lazy_chan(chan):
+    # Paths are fetched by the owning data_stor on first access
+    __slots__ = ('stor', '_paths', 'inters_loaded')
+
+    def __init__(self, dest: Node = None, src: Node = None, stor=None):
+        chan.__init__(self, dest, src)
+        self.stor = stor
+        self._paths = None
+        self.inters_loaded = False
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            self.stor._fetch_paths(self)
+        return self._paths
+
+    @paths.setter
+    def paths(self, val):
+        self._paths = val
 
-    dbconn.close()
+
+class lazy_path(path):
+    # Interactions (and the length derived from them) are fetched per channel batch on first access
+    __slots__ = ('_interactions', '_length')
+
+    def __init__(self):
+        path.__init__(self)
+        self._interactions = None
+
+    @property
+    def interactions(self):
+        if self._interactions is None:
+            self.chan.stor._fetch_iters(self.chan)
+        return self._interactions
+
+    @interactions.setter
+    def interactions(self, val):
+        self._interactions = val
+
+    @property
+    def length(self):
+        if self._interactions is None:
+            self.chan.stor._fetch_iters(self.chan)
+        return self._length
+
+    @length.setter
+    def length(self, val):
+        self._length = val
+
+
+# Shared stand-ins for interactions loaded with store=False, a path only keeps a reference sized by the count
+_placeholders = dict()
+
+
+def _no_inters(n: int):
+    if n not in _placeholders:
+        _placeholders[n] = (False,) * n
+    return _placeholders[n]
+
+
+# (host, user, database) -> connection pool, shared by every data_stor of the process
+_mysql_pools = dict()
+_mysql_pools_lock = threading.Lock()
+
+
+def _mysql_pool(host: str, user: str, pw: str, dbname: str, size: int):
+    with _mysql_pools_lock:
+        key = (host, user, dbname)
+        size = min(size, pooling.CNX_POOL_MAXSIZE)
+        if key not in _mysql_pools or _mysql_pools[key].pool_size < size:
+            # The pool opens all its connections up front, so every TLS handshake happens once per process.
+            # A smaller pool is replaced, connections still out go back to the old one.
+            _mysql_pools[key] = pooling.MySQLConnectionPool(pool_name='wi{}_{}'.format(_mysql_pools.__len__(), size),
+                                                            pool_size=size,
+                                                            host=host, user=user, password=pw,
+                                                            client_flags=[ClientFlag.SSL], database=dbname)
+        return _mysql_pools[key]
+
+
+def _same_state(a: list, b: list):
+    # TX_STATE rows, the power sums may differ in the last bits between query plans
+    if a is None or b is None or a.__len__() != b.__len__():
+        return a == b
+    return all(i == j if not isinstance(i, float) or not isinstance(j, float) else abs(i - j) <= 1e-9 * abs(j)
+               for i, j in zip(a, b))
+
+
+def _connect(dbspec: tuple):
+    # dbspec is ('sqlite', path) or ('mysql', host, user, password, dbname), see data_stor.dbspec
+    if dbspec[0] == 'sqlite':
+        return sqlite3.connect(Path(dbspec[1]).as_uri() + '?mode=ro', uri=True)
+    return msqlc.connect(host=dbspec[1], user=dbspec[2], password=dbspec[3], client_flags=[ClientFlag.SSL],
+                         database=dbspec[4])
+
+
+# Connection of a worker process, kept for all batches the process gets while the study stays the same
+_proc_dbconn = None
+_proc_dbspec = None
+
+
+def _in_process(fn: callable, dbspec: tuple, *args):
+    # Runs in a worker process, arrays of the result go back through shared memory
+    global _proc_dbconn, _proc_dbspec
+    if _proc_dbconn is not None and _proc_dbspec != dbspec:
+        _proc_dbconn.close()
+        _proc_dbconn = None
+    if _proc_dbconn is None:
+        _proc_dbconn = _connect(dbspec)
+        _proc_dbspec = dbspec
+    try:
+        return _to_shm(fn(_proc_dbconn.cursor(), *args))
+    except (sqlite3.Error, msqlc.Error):
+        # The connection may be gone, reconnect on the next batch
+        try:
+            _proc_dbconn.close()
+        except (sqlite3.Error, msqlc.Error):
+            pass
+        _proc_dbconn = None
+        raise
+
+
+def _to_shm(res):
+    # Packs the arrays of a batch result (an array or a dict with arrays) into one shared memory block, only their
+    # layout is pickled back to the parent. Unpacked and freed by _from_shm.
+    single = not isinstance(res, dict)
+    items = {'': res} if single else res
+    arrs = {i[0]: i[1] for i in items.items() if isinstance(i[1], ndarray)}
+    size = sum(i.nbytes for i in arrs.values())
+    # On Windows a block is gone once its last handle is closed, which would be ours before the parent opens it,
+    # so results are pickled back as they are
+    if size == 0 or os.name == 'nt':
+        return res
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    layout = []
+    offset = 0
+    for i in arrs.items():
+        ndarray(i[1].shape, dtype=i[1].dtype, buffer=shm.buf, offset=offset)[...] = i[1]
+        layout.append((i[0], i[1].dtype.str, i[1].shape, offset))
+        offset += i[1].nbytes
+    shm.close()
+
+    return 'shm', shm.name, layout, {i[0]: i[1] for i in items.items() if i[0] not in arrs}, single
+
+
+def _from_shm(res):
+    if not isinstance(res, tuple) or res[0] != 'shm':
+        return res
+
+    shm = shared_memory.SharedMemory(name=res[1])
+    try:
+        out = dict(res[3])
+        for k, dtype, shape, offset in res[2]:
+            out[k] = ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return out[''] if res[4] else out
+
+
+def _fetch_paths_batch(dbcurs, ward: str, ids: list, npaths: int, conds: dict, windows: bool, bulk: bool):
+    # Channels and top paths of a batch of TX or RX ids as arrays, merged later by data_stor._merge_paths
+    idl = ','.join(str(i) for i in ids)
+
+    dbcurs.execute((TX_PAIRSIN if ward == 'TX' else RX_PAIRSIN).format(idl, **conds))
+    ch = asarray(dbcurs.fetchall(), dtype=float).reshape([-1, 7])
+    # TX_PAIRSIN ends with rx_id, tx_id, RX_PAIRSIN with tx_id, rx_id
+    txc, rxc = (6, 5) if ward == 'TX' else (5, 6)
+
+    rows = None
+    if not bulk:
+        rows = []
+        for i in ch[:, 0].astype(int64).tolist():
+            dbcurs.execute(CHAN_PTH_TOP.format(i, npaths, **conds))
+            rows.extend((i,) + tuple(j) for j in dbcurs.fetchall())
+    elif windows:
+        try:
+            dbcurs.execute((TX_RANGE_PTH_TOP if ward == 'TX' else RX_RANGE_PTH_TOP).format(idl, npaths, **conds))
+            rows = dbcurs.fetchall()
+        except (sqlite3.Error, msqlc.Error):
+            windows = False
+    if rows is None:
+        dbcurs.execute((TX_RANGE_PTH if ward == 'TX' else RX_RANGE_PTH).format(idl, **conds))
+        rows = dbcurs.fetchall()
+
+    pth = asarray([i[0:10] for i in rows], dtype=float).reshape([-1, 10])
+    # Strongest first within every channel, then cut to npaths in case the DB did not
+    pth = pth[lexsort((-pth[:, 2], pth[:, 0]))]
+    first = searchsorted(pth[:, 0], pth[:, 0], side='left')
+    pth = pth[arange(pth.shape[0]) - first < npaths]
+
+    return {'chid': ch[:, 0].astype(int64), 'tx': ch[:, txc].astype(int64), 'rx': ch[:, rxc].astype(int64),
+            'chan': ch[:, 1:4], 'pchid': pth[:, 0].astype(int64), 'pathid': pth[:, 1].astype(int64),
+            'path': pth[:, 2:10], 'windows': windows}
+
+
+def _fetch_iters_batch(dbcurs, ward: str, ids: list, conds: dict):
+    # Interactions of a batch of TX or RX ids as (path_id, x, y, z, type) rows
+    dbcurs.execute((TX_RANGE_INTERS if ward == 'TX' else RX_RANGE_INTERS).format(','.join(str(i) for i in ids),
+                                                                                 **conds))
+    return asarray(dbcurs.fetchall(), dtype=float).reshape([-1, 5])
 
 
 class data_stor():
     def __init__(self, conf: str = None, threaded: bool = True):
         self.txs = dict()
         self.rxs = dict()
+        # Node coordinates, one row per node, Node.coords are views into these
+        self.tx_coords = zeros([0, 3])
+        self.rx_coords = zeros([0, 3])
         self.dbname = None
         self.dbconn = None
         self.dbcurs = None
         self.possible_inters = dict()
-        self.threshold_chan = -115
-        self.threshold_path = -125
+        # Set by load_rxtx/load_paths and pushed down into the loader queries, [-1]/None means no filter.
+        # Thresholds are in dBm.
+        self.txgrp = [-1]
+        self.rxgrp = [-1]
+        self.threshold_chan = None
+        self.threshold_path = None
         self.threaded = threaded
+        self.sql_windows = True
+        self.nthreads = cpu_count()
+        # Work is handed out in about nthreads * batches_per_worker batches of similar path count
+        self.batches_per_worker = 4
+        # Batches failing with a DB error are resubmitted this many times before giving up
+        self.retries = 2
+        # Parallel loading with worker processes, MySQL can use pooled threads instead
+        self.processes = True
+        # Worker processes and their connections are kept across loading stages until close
+        self.executor = None
+        self.costs = None
+        self.cache_dir = '.wicache'
+        # Keep cached/mapped path columns in float32, see path_store.to_float32
+        self.float32 = False
+        self.store = None
+        # Cache directory of the loaded study and per-TX state it was loaded at, see update
+        self.cpath = None
+        self.tx_state = None
+        self.store_inters = True
+        # (tx_id, rx_id) -> chan
+        self.chans = dict()
+        self.lazy = False
+        self.lazy_store = True
+        self.prefetch = 32
 
         if conf is not None:
             conff = open(conf)
@@ -275,8 +393,8 @@ class data_stor():
             self.pasw = conff.readline().strip('\n')
             print('Connecting to {} as {}'.format(self.host, self.user))
             conff.close()
-            self.nthreads =  cpu_count()
             print('Will use up to {} threads...'.format(self.nthreads))
+            # Shared MySQL connection pool, see _mysql
             self.pool = None
 
     def __repr__(self):
@@ -288,39 +406,352 @@ class data_stor():
         else:
             return 'Database in file {}.'.format(self.dbname)
 
-    def load_rxtx(self, dbname: str = None):
+    @property
+    def conds(self):
+        return self._conds(self.txgrp, self.rxgrp)
+
+    def _conds(self, txgrp: list, rxgrp: list):
+        chcond = ''
+        if txgrp[0] != -1:
+            chcond += ' AND channel.tx_id IN (SELECT tx_id FROM tx WHERE tx_set_id IN ({}))'.format(
+                ','.join(str(i) for i in txgrp))
+        if rxgrp[0] != -1:
+            chcond += ' AND channel.rx_id IN (SELECT rx_id FROM rx WHERE rx_set_id IN ({}))'.format(
+                ','.join(str(i) for i in rxgrp))
+
+        pcond = ''
+        icond = ''
+        # received_power is stored in W, see the * 1e3 when loading
+        if self.threshold_chan is not None:
+            chcond += ' AND channel.channel_id IN (SELECT channel_id FROM channel_utd ' \
+                      'WHERE received_power >= {})'.format(db2l(self.threshold_chan) * 1e-3)
+        if self.threshold_path is not None:
+            pcond = ' AND path_utd.received_power >= {}'.format(db2l(self.threshold_path) * 1e-3)
+            icond = ' AND interaction.path_id IN (SELECT path_id FROM path_utd WHERE received_power >= {})'.format(
+                db2l(self.threshold_path) * 1e-3)
+
+        return {'chcond': chcond, 'pcond': pcond, 'icond': icond}
+
+    def _mysql(self, dbname: str = None):
+        # Pooled connection, close() hands it back to the pool instead of disconnecting.
+        # With worker processes doing the fetching we only need connections for the odd query of our own.
+        dbname = dbname if dbname is not None else self.dbname
+        self.pool = _mysql_pool(self.host, self.user, self.pasw, dbname, 2 if self.processes else self.nthreads + 1)
+        try:
+            return self.pool.get_connection()
+        except msqlc.PoolError:
+            # Every pooled connection is held, e.g. by lazy stores or open iter_chunks generators, which may never
+            # give it back while we wait. An unpooled one is disconnected by close().
+            return _connect(('mysql', self.host, self.user, self.pasw, dbname))
+
+    @property
+    def dbspec(self):
+        # Everything a worker process needs to open its own connection
+        if hasattr(self, 'host'):
+            return 'mysql', self.host, self.user, self.pasw, self.dbname
+        return 'sqlite', os.path.abspath(self.dbname)
+
+    def _count_paths(self, ward: str):
+        # Cheap pre-count: number of paths behind every TX/RX, unknown ids are ignored later
+        self.dbcurs.execute((TX_PATH_COUNT if ward == 'TX' else RX_PATH_COUNT).format(**self.conds))
+        return {i[0]: i[1] for i in self.dbcurs.fetchall()}
+
+    def _plan_batches(self, ward: str):
+        nodes = self.txs if ward == 'TX' else self.rxs
+        if self.costs is None or self.costs[0] != ward:
+            self.costs = (ward, self._count_paths(ward))
+        # Nodes without paths still cost a channel query
+        cost = {i: self.costs[1].get(i, 0) + 1 for i in nodes.keys()}
+        target = max(1, sum(cost.values()) / (self.nthreads * self.batches_per_worker))
+
+        batches = []
+        batch = []
+        acc = 0
+        for i in sorted(cost.keys()):
+            batch.append(i)
+            acc += cost[i]
+            if acc >= target:
+                batches.append((acc, batch))
+                batch = []
+                acc = 0
+        if batch.__len__() > 0:
+            batches.append((acc, batch))
+
+        # Heaviest first, so that a dense group never ends up as the last straggler
+        batches.sort(key=lambda t: t[0], reverse=True)
+        return [i[1] for i in batches]
+
+    def _ward(self):
+        # Batch along whichever of TX/RX has more nodes, finer batches balance better
+        return 'TX' if self.txs.__len__() > self.rxs.__len__() else 'RX'
+
+    def _pooled(self, fn: callable, *args):
+        # Runs in a worker thread with a connection borrowed from the pool
+        dbconn = self._mysql()
+        try:
+            return fn(dbconn.cursor(), *args)
+        finally:
+            dbconn.close()
+
+    def close(self):
+        # Stops the worker processes, the next parallel load starts new ones
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __del__(self):
+        if getattr(self, 'executor', None) is not None:
+            self.executor.shutdown(wait=False)
+
+    def _workers(self):
+        if self.executor is None:
+            if os.name == 'posix':
+                # Workers must share our resource tracker, their shared memory blocks are unlinked here
+                resource_tracker.ensure_running()
+            self.executor = cof.ProcessPoolExecutor(max_workers=self.nthreads)
+        return self.executor
+
+    def _run_batches(self, fn: callable, ward: str, batches: list, merge: callable, *args):
+        # Workers only fetch, every result is merged here in the calling thread as soon as it is done
+        if hasattr(self, 'host') and not self.processes:
+            with cof.ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                self._collect(lambda ids: executor.submit(self._pooled, fn, ward, ids, *args), ward, batches, merge)
+            return
+
+        # Row parsing and conversion to arrays happen outside of the GIL, one connection per worker process.
+        # The same processes serve paths and interactions, so their connections are opened once.
+        executor = self._workers()
+        try:
+            self._collect(lambda ids: executor.submit(_in_process, fn, self.dbspec, ward, ids, *args), ward, batches,
+                          merge)
+        except cof.process.BrokenProcessPool:
+            # A worker died, the pool cannot be used any more
+            self.executor = None
+            raise
+
+    def _collect(self, submit: callable, ward: str, batches: list, merge: callable):
+        futs = {submit(i): (i, 0) for i in batches}
+        try:
+            while futs.__len__() > 0:
+                done, _ = cof.wait(futs, return_when=cof.FIRST_COMPLETED)
+                for i in done:
+                    ids, tries = futs.pop(i)
+                    try:
+                        res = _from_shm(i.result())
+                    except (sqlite3.Error, msqlc.Error) as e:
+                        if tries >= self.retries:
+                            raise
+                        print('Batch of {} {}s failed ({}), retrying...'.format(ids.__len__(), ward, e), end='',
+                              flush=True)
+                        futs[submit(ids)] = (ids, tries + 1)
+                        continue
+                    merge(ids, res)
+        finally:
+            # The workers outlive this stage, batches nobody will merge should not keep them busy
+            for i in futs:
+                i.cancel()
+
+    def _merge_paths(self, res: dict, register: bool = True, npaths: int = None):
+        chans = dict()
+        chan = res['chan'].tolist()
+        for i, (ch, tx, rx) in enumerate(zip(res['chid'].tolist(), res['tx'].tolist(), res['rx'].tolist())):
+            chans[ch] = self._mkchan(self.txs[tx], self.rxs[rx], [ch] + chan[i], register)
+        self._set_dists(chans.values())
+
+        # Paths come grouped by channel and strongest first, see _fetch_paths_batch
+        lo = searchsorted(res['pchid'], res['chid'], side='left').tolist()
+        hi = searchsorted(res['pchid'], res['chid'], side='right').tolist()
+        rows = list(zip(res['pathid'].tolist(), *res['path'].T.tolist()))
+        for i, ch in enumerate(res['chid'].tolist()):
+            self._mkpaths(chans[ch], rows[lo[i]:hi[i]], npaths, presorted=True)
+
+        self.sql_windows = self.sql_windows and res['windows']
+        return chans
+
+    def _merge_iters(self, ward: str, ids: list, rows, store: bool):
+        nodes = self.txs if ward == 'TX' else self.rxs
+        self._fill_iters([j for i in ids for j in nodes[i].chans_to_pairs.values()], rows, store)
+
+    def _mkchan(self, tx: Node, rx: Node, row, register: bool = True):
+        # Unregistered channels are not reachable from the nodes, see iter_channels
+        c = lazy_chan(dest=rx, src=tx, stor=self) if self.lazy and register else chan(dest=rx, src=tx)
+        c.pow = row[1] * 1e3
+        c.delay = row[2]
+        c.ds = row[3]
+        c.chid = row[0]
+        if register:
+            tx.chans_to_pairs[rx] = c
+            rx.chans_to_pairs[tx] = c
+            self.chans[(tx.node_id, rx.node_id)] = c
+        return c
+
+    def _set_dists(self, chans):
+        # Link distances of a whole batch at once, gathered from the node coordinate arrays
+        chans = list(chans)
+        if chans.__len__() == 0:
+            return
+        d = norm(self.tx_coords[[c.src.row for c in chans]] - self.rx_coords[[c.dest.row for c in chans]], axis=1)
+        for c, dist in zip(chans, d.tolist()):
+            c.dist = dist
+
+    def get_chan(self, tx: int, rx: int):
+        return self.chans.get((tx, rx))
+
+    def _mkpaths(self, c: chan, rows, npaths: int = None, presorted: bool = False):
+        # Rows follow CHAN_PTH column order, keep only the strongest npaths in case the DB did not
+        if not presorted:
+            rows = sorted(rows, key=lambda t: t[1], reverse=True)
+        for k in rows[0:npaths if npaths is not None else self.npaths]:
+            p = lazy_path() if isinstance(c, lazy_chan) else path()
+            p.chan = c
+            p.pathid = k[0]
+            p.pow = k[1] * 1e3
+            p.FSPL = k[7]
+            p.phase = k[8]
+            p.delay = k[2]
+            p.AoD = k[3]
+            p.EoD = k[4]
+            p.AoA = k[5]
+            p.EoA = k[6]
+            c.paths[k[0]] = p
+
+    def _range_paths(self, dbcurs, query: str, query_top: str, *args):
+        if self.sql_windows:
+            try:
+                dbcurs.execute(query_top.format(*args, self.npaths, **self.conds))
+                return dbcurs.fetchall()
+            except (sqlite3.Error, msqlc.Error):
+                # No window functions (SQLite < 3.25, MySQL < 8.0), fall back to cutting in Python
+                self.sql_windows = False
+
+        dbcurs.execute(query.format(*args, **self.conds))
+        return dbcurs.fetchall()
+
+    def _lazy_batch(self, c: lazy_chan, pending: callable):
+        # The requested channel plus the next few pending ones of the same TX
+        batch = [c]
+        for i in c.src.chans_to_pairs.values():
+            if batch.__len__() >= self.prefetch:
+                break
+            if i is not c and pending(i):
+                batch.append(i)
+        return batch
+
+    def _fetch_paths(self, c: lazy_chan):
+        batch = self._lazy_batch(c, lambda t: t._paths is None)
+        chans = dict()
+        for i in batch:
+            i.paths = dict()
+            chans[i.chid] = i
+
+        ids = ','.join(str(i) for i in chans.keys())
+        self._fill_paths(chans, self._range_paths(self.dbcurs, CHANS_PTH, CHANS_PTH_TOP, ids))
+
+    def _fetch_iters(self, c: lazy_chan):
+        batch = self._lazy_batch(c, lambda t: t._paths is not None and not t.inters_loaded)
+        for i in batch:
+            i.inters_loaded = True
+
+        self.dbcurs.execute(CHANS_INTERS.format(','.join(str(i.chid) for i in batch), **self.conds))
+        self._fill_iters(batch, self.dbcurs.fetchall(), self.lazy_store)
+
+    def _fill_paths(self, chans: dict, rows, npaths: int = None):
+        # Partition rows of a range query (channel_id first) by channel
+        parts = dict()
+        for i in rows:
+            if i[0] in chans:
+                parts.setdefault(i[0], []).append(i[1:])
+
+        for i in parts.items():
+            self._mkpaths(chans[i[0]], i[1], npaths)
+
+    def _fill_iters(self, chans: list, rows, store: bool):
+        # Rows are (path_id, x, y, z, interaction_type_id), possibly for more paths than requested
+        paths = [p for c in chans for p in c.paths.values()]
+        if paths.__len__() == 0:
+            return
+
+        rows = asarray(rows, dtype=float).reshape([-1, 5])
+        order = argsort(rows[:, 0], kind='stable')
+        rows = rows[order]
+
+        pids = asarray([p.pathid for p in paths], dtype=float)
+        first = searchsorted(rows[:, 0], pids, side='left')
+        counts = searchsorted(rows[:, 0], pids, side='right') - first
+        ptr = concatenate([[0], cumsum(counts)])
+        idx = repeat(first - ptr[:-1], counts) + arange(ptr[-1])
+
+        coords = rows[idx, 1:4]
+        npc = [c.paths.__len__() for c in chans]
+        lens = path_lengths(self.tx_coords[repeat([c.src.row for c in chans], npc)],
+                            self.rx_coords[repeat([c.dest.row for c in chans], npc)], coords, ptr).tolist()
+        coords = coords.tolist()
+        typs = rows[idx, 4].astype(int).tolist()
+        ptr = ptr.tolist()
+        counts = counts.tolist()
+
+        for i, p in enumerate(paths):
+            p.length = lens[i]
+            if store:
+                inters = []
+                for k in range(ptr[i], ptr[i + 1]):
+                    intr = interaction()
+                    intr.path = p
+                    intr.x, intr.y, intr.z = coords[k]
+                    intr.typ = typs[k]
+                    inters.append(intr)
+                p.interactions = inters
+            else:
+                p.interactions = _no_inters(counts[i])
+
+    def load_rxtx(self, dbname: str = None, txgrp: list = [-1], rxgrp: list = [-1]):
         print('Loading TX/RX nodes...', end='', flush=True)
 
+        self.txgrp = [txgrp] if not isinstance(txgrp, list) else txgrp
+        self.rxgrp = [rxgrp] if not isinstance(rxgrp, list) else rxgrp
+
         if self.dbconn is None:
             if not hasattr(self, 'host'):
                 self.dbconn = sqlite3.connect(dbname)
                 self.dbcurs = self.dbconn.cursor()
                 self.dbname = dbname
             else:
-                self.dbconn = msqlc.connect(host=self.host, user=self.user, password=self.pasw,
-                                            client_flags=[ClientFlag.SSL], database=dbname)
+                self.dbconn = self._mysql(dbname)
                 self.dbcurs = self.dbconn.cursor()
                 self.dbcurs.execute('USE {};'.format(dbname))
                 self.dbname = dbname
 
         # Read TX data
-        self.dbcurs.execute(TX_EXTR)
+        if self.txgrp[0] == -1:
+            self.dbcurs.execute(TX_EXTR)
+        else:
+            self.dbcurs.execute(TX_EXTR_GRP.format(','.join(str(i) for i in self.txgrp)))
         j = self.dbcurs.fetchall()
+        self.store = None
+        self.txs = dict()
+        self.tx_coords = asarray([i[1:4] for i in j], dtype=float).reshape([-1, 3])
 
-        for i in j:
+        for k, i in enumerate(j):
             n = Node('TX')
-            n.coords = asarray([i[1], i[2], i[3]])
+            n.coords = self.tx_coords[k]
+            n.row = k
             n.node_id = i[0]
             n.setid = i[4]
             self.txs[i[0]] = n
 
         # Read RX data
-        self.dbcurs.execute(RX_EXTR)
+        if self.rxgrp[0] == -1:
+            self.dbcurs.execute(RX_EXTR)
+        else:
+            self.dbcurs.execute(RX_EXTR_GRP.format(','.join(str(i) for i in self.rxgrp)))
         j = self.dbcurs.fetchall()
+        self.rxs = dict()
+        self.rx_coords = asarray([i[1:4] for i in j], dtype=float).reshape([-1, 3])
 
-        for i in j:
+        for k, i in enumerate(j):
             n = Node('RX')
-            n.coords = asarray([i[1], i[2], i[3]])
+            n.coords = self.rx_coords[k]
+            n.row = k
             n.node_id = i[0]
             n.setid = i[4]
             self.rxs[i[0]] = n
@@ -331,91 +762,70 @@ class data_stor():
             self.dbconn.close()
             self.dbconn = None
 
-    def load_paths(self, npaths: int = 250):
+    def load_paths(self, npaths: int = 250, bulk: bool = True, lazy: bool = False, threshold_chan: float = None,
+                   threshold_path: float = None):
         print('Loading paths...', end='', flush=True)
         self.npaths = npaths
+        self.lazy = lazy
+        self.threshold_chan = threshold_chan
+        self.threshold_path = threshold_path
+        self.chans = dict()
         if self.dbconn is None:
             if os.path.isfile(self.dbname) and not hasattr(self, 'host'):
                 print('Error: connect to DB and load txs/rxs first!')
                 exit(1)
             else:
-                self.dbconn = msqlc.connect(host=self.host, user=self.user, password=self.pasw,
-                                            client_flags=[ClientFlag.SSL], database=self.dbname)
+                self.dbconn = self._mysql()
                 
                 self.dbcurs = self.dbconn.cursor()
 
-        if hasattr(self, 'host') and self.threaded:
-            txs_per_thread = self.txs.__len__() / self.nthreads
-            rxs_per_thread = self.rxs.__len__() / self.nthreads
-
-            thread_pool = cof.ThreadPoolExecutor(max_workers=self.nthreads)
-
-            if txs_per_thread > rxs_per_thread:
-                print('TXward...', end='', flush=True)
-                txs_per_thread = int(txs_per_thread)
-                txs = []
-
-                for i in self.txs.keys():
-                    txs.append(i)
-                    if txs.__len__() == txs_per_thread:
-                        thread_pool.submit(_load_paths_txthread, self, txs, self.host, self.user, self.pasw, self.dbname)
-                        txs = []
-
-                if txs.__len__() > 0 or txs_per_thread <= 1:
-                    thread_pool.submit(_load_paths_txthread, self, txs, self.host, self.user, self.pasw, self.dbname)
-            else:
-                print('RXward...', end='', flush=True)
-                rxs_per_thread = int(rxs_per_thread)
-                rxs = []
-
-                for i in self.rxs.keys():
-                    rxs.append(i)
-                    if rxs.__len__() == rxs_per_thread:
-                        thread_pool.submit(_load_paths_rxthread, self, rxs, self.host, self.user, self.pasw, self.dbname)
-                        rxs = []
-
-                if rxs.__len__() > 0 or rxs_per_thread <= 1:
-                    thread_pool.submit(_load_paths_rxthread, self, rxs, self.host, self.user, self.pasw, self.dbname)
-
-            thread_pool.shutdown()
+        # Path counts depend on the filters above
+        self.costs = None
+
+        if lazy:
+            # Only channels now, paths and interactions are fetched on first access
+            print('Lazy...', end='', flush=True)
+            if self.txs.__len__() > 0:
+                self.dbcurs.execute(TX_PAIRSIN.format(','.join(str(i) for i in self.txs.keys()), **self.conds))
+                for i in self.dbcurs.fetchall():
+                    if i[-2] in self.rxs:
+                        self._mkchan(self.txs[i[-1]], self.rxs[i[-2]], i)
+                self._set_dists(self.chans.values())
+        elif self.threaded and self.txs.__len__() > 0 and (hasattr(self, 'host') or self.nthreads > 1):
+            ward = self._ward()
+            batches = self._plan_batches(ward)
+            print('{}ward, {} batches...'.format(ward, batches.__len__()), end='', flush=True)
+            self._run_batches(_fetch_paths_batch, ward, batches, lambda ids, res: self._merge_paths(res),
+                              self.npaths, self.conds, self.sql_windows, bulk)
         else:
+            chans = dict()
             for i in self.txs.keys():
-                self.dbcurs.execute(TX_PAIRS.format(i, i))
-                k = self.dbcurs.fetchall()
-                for j in k:
-                    dst = self.rxs[j[-1]]
-                    self.txs[i].chans_to_pairs[dst] = chan(dst, self.txs[i])
-                    dst.chans_to_pairs[self.txs[i]] = self.txs[i].chans_to_pairs[dst]
-                    self.txs[i].chans_to_pairs[dst].pow = j[1] * 1e3
-                    self.txs[i].chans_to_pairs[dst].delay = j[2]
-                    self.txs[i].chans_to_pairs[dst].ds = j[3]
-                    self.txs[i].chans_to_pairs[dst].dist = norm(self.txs[i].coords - dst.coords)
-                    self.txs[i].chans_to_pairs[dst].chid = j[0]
-
-                for j in self.txs[i].chans_to_pairs.keys():
-                    self.dbcurs.execute(CHAN_PTH.format(self.txs[i].chans_to_pairs[j].chid))
-                    d = self.dbcurs.fetchall()
-                    d = sorted(d, key=lambda t: t[1], reverse=True)
-                    for k in d[0:(self.npaths if d.__len__() >= self.npaths else d.__len__())]:
-                        self.txs[i].chans_to_pairs[j].paths[k[0]] = path()
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].pathid = k[0]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].chan = self.txs[i].chans_to_pairs[j]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].pow = k[1] * 1e3
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].FSPL = k[7]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].phase = k[8]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].delay = k[2]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].AoD = k[3]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].EoD = k[4]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].AoA = k[5]
-                        self.txs[i].chans_to_pairs[j].paths[k[0]].EoA = k[6]
+                self.dbcurs.execute(TX_PAIRS.format(i, i, **self.conds))
+                for j in self.dbcurs.fetchall():
+                    chans[j[0]] = self._mkchan(self.txs[i], self.rxs[j[-1]], j)
+            self._set_dists(chans.values())
+
+            if bulk and self.txs.__len__() > 0:
+                self._fill_paths(chans, self._range_paths(self.dbcurs, TX_RANGE_PTH, TX_RANGE_PTH_TOP,
+                                                          ','.join(str(i) for i in self.txs.keys())))
+            elif not bulk:
+                for i in chans.values():
+                    self.dbcurs.execute(CHAN_PTH_TOP.format(i.chid, self.npaths, **self.conds))
+                    self._mkpaths(i, self.dbcurs.fetchall())
 
         print('Success!')
 
-        if hasattr(self, 'host'):
+        # Lazy channels keep using the connection
+        if hasattr(self, 'host') and not lazy:
             self.dbconn.close()
             self.dbconn = None
 
     def load_interactions(self, store: bool = True):
+        self.store_inters = store
+        if self.lazy:
+            self.lazy_store = store
+            return
+
         print('Loading interactions...', end='', flush=True)
 
         if self.dbconn is None:
@@ -423,77 +833,396 @@ class data_stor():
                 print('Error: connect to DB and load txs/rxs first!')
                 exit(1)
             else:
-                self.dbconn = msqlc.connect(host=self.host, user=self.user, password=self.pasw,
-                                            client_flags=[ClientFlag.SSL], database=self.dbname)
+                self.dbconn = self._mysql()
                 self.dbcurs = self.dbconn.cursor()
 
-        if hasattr(self, 'host') and self.threaded:
-            txs_per_thread = self.txs.__len__() / self.nthreads
-            rxs_per_thread = self.rxs.__len__() / self.nthreads
-
-            thread_pool = cof.ThreadPoolExecutor(max_workers=self.nthreads)
-
-            if txs_per_thread > rxs_per_thread:
-                print('TXward...', end='', flush=True)
-                txs = []
-                txs_per_thread = int(txs_per_thread)
-                for i in self.txs.keys():
-                    if txs.__len__() % txs_per_thread == 0 and txs.__len__() != 0:
-                        #print(txs)
-                        thread_pool.submit(_load_iters_txs, self, txs, self.host, self.user, self.pasw,
-                                               self.dbname, store)
-                        txs = []
-                    txs.append(i)
-
-                if txs.__len__() != 0 or txs_per_thread <= 1:
-                    #print(txs)
-                    thread_pool.submit(_load_iters_txs, self, txs, self.host, self.user, self.pasw, self.dbname, store)
-            else:
-                print('RXward...', end='', flush=True)
-                rxs = []
-                rxs_per_thread = int(rxs_per_thread)
-                for i in self.rxs.keys():
-                    if rxs.__len__() % rxs_per_thread == 0 and rxs.__len__() != 0:
-                        #print(rxs)
-                        thread_pool.submit(_load_iters_rxs, self, rxs, self.host, self.user, self.pasw,
-                                               self.dbname, store)
-                        rxs = []
-                    rxs.append(i)
-
-                if rxs.__len__() != 0 or rxs_per_thread <= 1:
-                    #print(rxs)
-                    thread_pool.submit(_load_iters_rxs, self, rxs, self.host, self.user, self.pasw, self.dbname,
-                                       store)
-
-            thread_pool.shutdown()
-        else:
-            for i in self.txs.items():
-                for j in i[1].chans_to_pairs.items():
-                    self.dbcurs.execute(INTERS_SPEC_CHAN.format(j[1].chid))
-                    inters = self.dbcurs.fetchall()
-                    for k in j[1].paths.items():
-                        dists = []
-                        precoords = i[1].coords
-                        for l in inters:
-                            if l[4] == k[1].pathid:
-                                if store:
-                                    intr = interaction()
-                                    intr.path = k[1]
-                                    intr.coords = asarray([l[0], l[1], l[2]])
-                                    intr.typ = l[3]
-                                    dists.append(norm(precoords - intr.coords))
-                                    precoords = intr.coords
-                                else:
-                                    intr = False
-                                k[1].interactions.append(intr)
-                        dists.append(norm(precoords - j[1].dest.coords))
-                        k[1].length = sum(dists)
+        if self.threaded and self.txs.__len__() > 0 and (hasattr(self, 'host') or self.nthreads > 1):
+            ward = self._ward()
+            batches = self._plan_batches(ward)
+            print('{}ward, {} batches...'.format(ward, batches.__len__()), end='', flush=True)
+            self._run_batches(_fetch_iters_batch, ward, batches,
+                              lambda ids, rows: self._merge_iters(ward, ids, rows, store), self.conds)
+        elif self.txs.__len__() > 0:
+            chans = [j for i in self.txs.values() for j in i.chans_to_pairs.values()]
+            self.dbcurs.execute(TX_RANGE_INTERS.format(','.join(str(i) for i in self.txs.keys()), **self.conds))
+            self._fill_iters(chans, self.dbcurs.fetchall(), store)
         print('Success!', flush=True)
 
         if hasattr(self, 'host'):
             self.dbconn.close()
             self.dbconn = None
 
+    def iter_chunks(self, txgrp: list = [-1], rxgrp: list = [-1], chunk: int = 16, npaths: int = 250,
+                    store: bool = False, nff: bool = False, freq: float = 60e9):
+        '''Yields lists of channels with paths and interactions straight from the DB, chunk TXs at a time.
+
+        Only the TX/RX nodes of load_rxtx are kept, channels are dropped once the caller moves on to the next chunk,
+        so memory stays bounded by one chunk. With store=False interactions are only counted, which is all most
+        one-pass statistics need. nff runs check_chan_NF at freq on every channel, which needs the interactions
+        stored, so that near_field_failed is set the same way check_data_NF sets it on a loaded study.'''
+        # phys_path_procs imports this module
+        from phys_path_procs import check_chan_NF
+        store = store or nff
+        txgrp = [txgrp] if not isinstance(txgrp, list) else txgrp
+        rxgrp = [rxgrp] if not isinstance(rxgrp, list) else rxgrp
+        # RX nodes not loaded by load_rxtx can not be built, only the loaded ones of the requested groups are used
+        if rxgrp[0] == -1:
+            rxgrp = self.rxgrp
+        elif self.rxgrp[0] != -1:
+            rxgrp = [i for i in rxgrp if i in self.rxgrp]
+        if rxgrp.__len__() == 0:
+            return
+        conds = self._conds(txgrp, rxgrp)
+        ids = sorted(i[0] for i in self.txs.items() if i[1].setid in txgrp or txgrp[0] == -1)
+
+        # Own connection, the generator may be consumed slowly or abandoned half way
+        dbconn = self._mysql() if hasattr(self, 'host') else _connect(self.dbspec)
+        dbcurs = dbconn.cursor()
+        try:
+            for i in range(0, ids.__len__(), chunk):
+                res = _fetch_paths_batch(dbcurs, 'TX', ids[i:i + chunk], npaths, conds, self.sql_windows, True)
+                chans = list(self._merge_paths(res, register=False, npaths=npaths).values())
+                self._fill_iters(chans, _fetch_iters_batch(dbcurs, 'TX', ids[i:i + chunk], conds), store)
+                if nff:
+                    for c in chans:
+                        check_chan_NF(c, freq=freq)
+                yield chans
+        finally:
+            dbconn.close()
+
+    def iter_channels(self, txgrp: list = [-1], rxgrp: list = [-1], batch: int = 16, npaths: int = 250,
+                      store: bool = False, nff: bool = False, freq: float = 60e9):
+        # Same as iter_chunks, one channel at a time
+        for i in self.iter_chunks(txgrp, rxgrp, chunk=batch, npaths=npaths, store=store, nff=nff, freq=freq):
+            yield from i
+
+    def to_store(self):
+        st = path_store.from_stor(self)
+        return st.to_float32() if self.float32 else st
+
+    def _signature(self, dbname: str):
+        # Anything that changes when the study is re-simulated or re-uploaded
+        if not hasattr(self, 'host'):
+            st = os.stat(dbname)
+            return {'source': os.path.abspath(dbname), 'mtime': st.st_mtime, 'size': st.st_size}
+
+        dbconn = self._mysql(dbname)
+        dbcurs = dbconn.cursor()
+        sig = {'source': '{}@{}'.format(dbname, self.host)}
+        for i in ['tx', 'rx', 'channel', 'channel_utd', 'path', 'path_utd', 'interaction']:
+            dbcurs.execute(TABLE_ROWS.format(i))
+            sig[i] = dbcurs.fetchall()[0][0]
+        dbconn.close()
+        return sig
+
+    def _cache_path(self, dbname: str, npaths: int, store: bool):
+        # Studies with the same name in different folders or on different servers get their own cache
+        name = os.path.basename(dbname.rstrip('/\\')).replace('.', '_')
+        source = '{}@{}'.format(dbname, self.host) if hasattr(self, 'host') else os.path.abspath(dbname)
+        return os.path.join(self.cache_dir, '{}_{}_{}_{}{}'.format(name, hashlib.md5(source.encode()).hexdigest()[0:8],
+                                                                   npaths, 'st' if store else 'ns',
+                                                                   '_f32' if self.float32 else ''))
+
+    def _from_store(self, st: path_store):
+        self.store = None
+        self.txs = dict()
+        self.rxs = dict()
+        self.chans = dict()
+
+        self.tx_coords = asarray(st.tx_coords, dtype=float).copy()
+        self.rx_coords = asarray(st.rx_coords, dtype=float).copy()
+
+        txn = []
+        for i in range(st.tx_id.size):
+            n = Node('TX')
+            n.coords = self.tx_coords[i]
+            n.row = i
+            n.node_id = int(st.tx_id[i])
+            n.setid = int(st.tx_setid[i])
+            self.txs[n.node_id] = n
+            txn.append(n)
+
+        rxn = []
+        for i in range(st.rx_id.size):
+            n = Node('RX')
+            n.coords = self.rx_coords[i]
+            n.row = i
+            n.node_id = int(st.rx_id[i])
+            n.setid = int(st.rx_setid[i])
+            self.rxs[n.node_id] = n
+            rxn.append(n)
+
+        # Plain lists are much faster to walk element by element than arrays
+        cols = dict()
+        for i in path_store.CHAN_COLS + path_store.PATH_COLS + path_store.INTER_COLS:
+            cols[i] = getattr(st, i).tolist()
+        cols['delay'] = st.path_delay.tolist()
+
+        for i in range(cols['chid'].__len__()):
+            tx = txn[cols['chan_tx'][i]]
+            rx = rxn[cols['chan_rx'][i]]
+            c = chan(dest=rx, src=tx)
+            tx.chans_to_pairs[rx] = c
+            rx.chans_to_pairs[tx] = c
+            c.chid = cols['chid'][i]
+            c.pow = cols['chan_pow'][i]
+            c.delay = cols['chan_delay'][i]
+            c.ds = cols['chan_ds'][i]
+            c.dist = cols['chan_dist'][i]
+            self.chans[(tx.node_id, rx.node_id)] = c
+
+            for j in range(cols['chan_ptr'][i], cols['chan_ptr'][i + 1]):
+                p = path()
+                p.chan = c
+                p.pathid = cols['pathid'][j]
+                for k in ('pow', 'delay', 'phase', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length'):
+                    setattr(p, k, cols[k][j])
+                p.near_field_failed = cols['nff'][j]
+                lo = cols['inter_ptr'][j]
+                hi = cols['inter_ptr'][j + 1]
+                # Interactions of a path are either all placeholders (store=False) or none
+                if hi > lo and cols['inter_typ'][lo] < 0:
+                    p.interactions = _no_inters(hi - lo)
+                else:
+                    for k in range(lo, hi):
+                        intr = interaction()
+                        intr.path = p
+                        intr.x, intr.y, intr.z = cols['inter_coords'][k]
+                        intr.typ = cols['inter_typ'][k]
+                        p.interactions.append(intr)
+                c.paths[p.pathid] = p
+
+    def _attach_store(self, st: path_store):
+        # Serve txs/rxs as views over the arrays instead of Node/chan/path objects
+        v = st.view()
+        self.txs = v.txs
+        self.rxs = v.rxs
+        self.chans = v.chans
+        self.tx_coords, self.rx_coords = st.tx_coords, st.rx_coords
+        self.store = st
+
+    def load(self, dbname: str, npaths: int = 250, store: bool = True, cache: bool = True, mmap: bool = False,
+             lazy: bool = False, txgrp: list = [-1], rxgrp: list = [-1], threshold_chan: float = None,
+             threshold_path: float = None):
+        # load_rxtx + load_paths + load_interactions, served from the on-disk cache when it is up to date.
+        # mmap keeps the cached columns memory-mapped and exposes them through pathstore views.
+        # lazy defers paths/interactions to first access when there is no usable cache.
+        txgrp = [txgrp] if not isinstance(txgrp, list) else txgrp
+        rxgrp = [rxgrp] if not isinstance(rxgrp, list) else rxgrp
+
+        self.cpath = None
+        self.tx_state = None
+        if not cache:
+            self.load_rxtx(dbname, txgrp=txgrp, rxgrp=rxgrp)
+            self.load_paths(npaths=npaths, lazy=lazy, threshold_chan=threshold_chan, threshold_path=threshold_path)
+            self.load_interactions(store=store)
+            self.close()
+            if not lazy:
+                self.tx_state = self._tx_state()
+            return
+
+        self.dbname = dbname
+        self.npaths = npaths
+        self.txgrp, self.rxgrp = txgrp, rxgrp
+        self.threshold_chan, self.threshold_path = threshold_chan, threshold_path
+        self.store_inters = store
+        cpath, sig = self._cache_key()
+        meta = path_store.read_meta(cpath)
+        state = meta.pop('tx_state', None) if meta is not None else None
+
+        # A cache of the same selection from before a partial re-simulation only needs the changed TXs
+        if meta == sig or (state is not None and meta.get('source') == sig['source'] and
+                           meta.get('filter') == sig['filter'] and meta.get('precision') == sig['precision']):
+            print('Loading cached study from {}...'.format(cpath), end='', flush=True)
+            try:
+                st = path_store.load(cpath, mmap=mmap)
+            except OSError:
+                # Replaced or removed by another process meanwhile, same as no cache
+                print('Failed, loading from DB', flush=True)
+                st = None
+            if st is not None:
+                self.cpath = cpath
+                self.tx_state = state
+                if mmap:
+                    self._attach_store(st)
+                else:
+                    self._from_store(st)
+                print('Success!', flush=True)
+                if meta != sig:
+                    self.update(reload_unchanged=True)
+                return
+
+        self.tx_state = self._tx_state()
+        self.load_rxtx(dbname, txgrp=txgrp, rxgrp=rxgrp)
+        self.load_paths(npaths=npaths, lazy=lazy, threshold_chan=threshold_chan, threshold_path=threshold_path)
+        self.load_interactions(store=store)
+        self.close()
+
+        if lazy:
+            # Nothing is loaded yet, so there is nothing to cache
+            return
+
+        self.cpath = cpath
+        st = self.to_store()
+        self._save_cache(st, sig)
+
+        if mmap:
+            self._attach_store(self._reload_store(st))
+
+    def _cache_key(self):
+        filt = [sorted(self.txgrp), sorted(self.rxgrp), self.threshold_chan, self.threshold_path]
+        sig = self._signature(self.dbname)
+        sig['filter'] = filt
+        sig['precision'] = 'float32' if self.float32 else 'float64'
+        cpath = self._cache_path(self.dbname, self.npaths, self.store_inters)
+        if filt != [[-1], [-1], None, None]:
+            cpath += '_' + hashlib.md5(repr(filt).encode()).hexdigest()[0:8]
+        return cpath, sig
+
+    def _save_cache(self, st: path_store, sig: dict):
+        print('Caching study to {}...'.format(self.cpath), end='', flush=True)
+        meta = dict(sig)
+        meta['tx_state'] = self.tx_state
+        st.save(self.cpath, meta=meta)
+        print('Success!', flush=True)
+
+    def _reload_store(self, st: path_store):
+        # Mapped copy of the snapshot just written, st itself if another process replaced it meanwhile
+        try:
+            return path_store.load(self.cpath, mmap=True)
+        except OSError:
+            return st
+
+    def _tx_state(self):
+        dbconn = self._mysql() if hasattr(self, 'host') else _connect(self.dbspec)
+        try:
+            dbcurs = dbconn.cursor()
+            dbcurs.execute(TX_STATE.format(**self.conds))
+            # Keys are strings so that the state survives the trip through meta.json
+            return {str(i[0]): list(i[1:]) for i in dbcurs.fetchall()}
+        finally:
+            dbconn.close()
+
+    def update(self, reload_unchanged: bool = False):
+        '''Brings a loaded study up to date with the DB after a partial re-simulation.
+
+        Only TXs whose channel/path counts, highest ids or received power sums differ from the state at load time
+        (see TX_STATE) are fetched again, added TXs are loaded and removed ones dropped. The on-disk cache is patched
+        the same way. A changed RX set affects every channel and means a full reload, as does reload_unchanged when
+        no TX changed (the DB did change, just not in a way TX_STATE sees). Returns the ids of the refreshed TXs.'''
+        assert not self.lazy, 'Lazy studies read paths from the DB on access, load them without lazy to update'
+        print('Checking for changed TXs...', end='', flush=True)
+
+        dbconn = self._mysql() if hasattr(self, 'host') else _connect(self.dbspec)
+        try:
+            dbcurs = dbconn.cursor()
+            if self.txgrp[0] == -1:
+                dbcurs.execute(TX_EXTR)
+            else:
+                dbcurs.execute(TX_EXTR_GRP.format(','.join(str(i) for i in self.txgrp)))
+            txrows = {i[0]: i for i in dbcurs.fetchall()}
+            if self.rxgrp[0] == -1:
+                dbcurs.execute(RX_EXTR)
+            else:
+                dbcurs.execute(RX_EXTR_GRP.format(','.join(str(i) for i in self.rxgrp)))
+            rxrows = dbcurs.fetchall()
+            dbcurs.execute(TX_STATE.format(**self.conds))
+            state = {str(i[0]): list(i[1:]) for i in dbcurs.fetchall()}
+
+            old = self.tx_state if self.tx_state is not None else dict()
+            nodes = {n.node_id: list(n.coords.tolist()) + [n.setid] for n in self.txs.values()}
+            changed = [i for i in txrows if nodes.get(i) != list(txrows[i][1:5]) or
+                       not _same_state(state.get(str(i)), old.get(str(i)))]
+            removed = [i for i in nodes if i not in txrows]
+            print('{} changed, {} removed...'.format(changed.__len__(), removed.__len__()), end='', flush=True)
+
+            rxmoved = {i[0]: list(i[1:5]) for i in rxrows} != {n.node_id: list(n.coords.tolist()) + [n.setid]
+                                                               for n in self.rxs.values()}
+            if rxmoved or (reload_unchanged and not changed and not removed):
+                print('{}, reloading everything...'.format('RX nodes changed' if rxmoved else 'Study changed'),
+                      flush=True)
+                mmap = self.store is not None
+                self.tx_state = state
+                self.load_rxtx(self.dbname, txgrp=self.txgrp, rxgrp=self.rxgrp)
+                self.load_paths(npaths=self.npaths, threshold_chan=self.threshold_chan,
+                                threshold_path=self.threshold_path)
+                self.load_interactions(store=self.store_inters)
+                self.close()
+                if self.cpath is not None:
+                    st = self.to_store()
+                    self._save_cache(st, self._cache_key()[1])
+                    if mmap:
+                        self._attach_store(self._reload_store(st))
+                return list(txrows.keys())
+
+            # Fetch the changed TXs into a scratch storage, over our own RX nodes when we have them
+            sub = data_stor()
+            sub.npaths = self.npaths
+            sub.float32 = self.float32
+            sub.sql_windows = self.sql_windows
+            if self.store is None:
+                sub.rxs, sub.rx_coords = self.rxs, self.rx_coords
+            else:
+                sub.rx_coords = asarray([i[1:4] for i in rxrows], dtype=float).reshape([-1, 3])
+                for k, i in enumerate(rxrows):
+                    n = Node('RX')
+                    n.coords = sub.rx_coords[k]
+                    n.row = k
+                    n.node_id = i[0]
+                    n.setid = i[4]
+                    sub.rxs[i[0]] = n
+            sub.tx_coords = asarray([txrows[i][1:4] for i in changed], dtype=float).reshape([-1, 3])
+            for k, i in enumerate(changed):
+                n = Node('TX')
+                n.coords = sub.tx_coords[k]
+                n.row = k
+                n.node_id = i
+                n.setid = txrows[i][4]
+                sub.txs[i] = n
+
+            # Old channels go first, with our own RX nodes they would collide with the new ones
+            drop = set(changed) | set(removed)
+            if self.store is None:
+                for i in drop.intersection(self.txs.keys()):
+                    n = self.txs.pop(i)
+                    for rx in n.chans_to_pairs.keys():
+                        del rx.chans_to_pairs[n]
+                        del self.chans[(i, rx.node_id)]
+
+            for i in range(0, changed.__len__(), 16):
+                ids = changed[i:i + 16]
+                res = _fetch_paths_batch(dbcurs, 'TX', ids, self.npaths, self.conds, self.sql_windows, True)
+                chans = list(sub._merge_paths(res).values())
+                sub._fill_iters(chans, _fetch_iters_batch(dbcurs, 'TX', ids, self.conds), self.store_inters)
+        finally:
+            dbconn.close()
+
+        part = sub.to_store()
+        print('Success!', flush=True)
+        self.tx_state = state
+        self.sql_windows = sub.sql_windows
+        if self.store is None:
+            self.txs.update(sub.txs)
+            self.chans.update(sub.chans)
+            self.tx_coords = asarray([n.coords for n in self.txs.values()], dtype=float).reshape([-1, 3])
+            for k, n in enumerate(self.txs.values()):
+                n.coords = self.tx_coords[k]
+                n.row = k
+            if self.cpath is not None:
+                try:
+                    st = path_store.load(self.cpath, mmap=True).replace_tx(part, drop)
+                except OSError:
+                    st = self.to_store()
+                self._save_cache(st, self._cache_key()[1])
+        else:
+            st = self.store.replace_tx(part, drop)
+            if self.cpath is not None:
+                self._save_cache(st, self._cache_key()[1])
+                st = self._reload_store(st)
+            self._attach_store(st)
+
+        return changed
+
     def dump_paths(self,  txgrp: list = [-1], rxgrp: list = [-1], csvsav: bool = True, matsav: bool = True):
         for i in self.txs.items():
             if i[1].setid in txgrp or txgrp[0] == -1:
@@ -507,8 +1236,8 @@ class data_stor():
                     delay = []
                     pathlen = []
                     if j[1].setid in rxgrp or rxgrp[0] == -1:
-                        if i[1].chan_to(j[1]):
-                            for k in i[1].chans_to_pairs[j[1]].paths.items():
+                        if self.get_chan(i[0], j[0]):
+                            for k in self.get_chan(i[0], j[0]).paths.items():
                                 AoA.append(k[1].AoA)
                                 EoA.append(k[1].EoA)
                                 AoD.append(k[1].AoD)
@@ -0,0 +1,445 @@
+# Copyright (C) Aleksei Ponomarenko-Timofeev
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import os
+import json
+import shutil
+import tempfile
+
+__author__ = 'Aleksei Ponomarenko-Timofeev'
+
+
+class path_store():
+    '''Struct-of-arrays storage of a loaded study.
+
+    Channels index their paths and paths index their interactions CSR-style: paths of channel c are
+    chan_ptr[c]:chan_ptr[c + 1], interactions of path p are inter_ptr[p]:inter_ptr[p + 1].
+    Powers are linear [mW] as in pairdata objects. Path delays are offsets from chan_toa of their channel,
+    which is zero unless the store was narrowed with to_float32.'''
+
+    NODE_COLS = ('tx_id', 'tx_coords', 'tx_setid', 'rx_id', 'rx_coords', 'rx_setid')
+    CHAN_COLS = ('chid', 'chan_tx', 'chan_rx', 'chan_pow', 'chan_delay', 'chan_ds', 'chan_dist', 'chan_toa',
+                 'chan_ptr')
+    PATH_COLS = ('pathid', 'pow', 'delay', 'phase', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length', 'nff', 'inter_ptr')
+    INTER_COLS = ('inter_coords', 'inter_typ')
+    FLOAT32_COLS = ('pow', 'delay', 'phase', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length', 'inter_coords')
+    COLS = NODE_COLS + CHAN_COLS + PATH_COLS + INTER_COLS
+
+    def __init__(self):
+        self.tx_id = np.zeros([0], dtype=np.int64)
+        self.tx_coords = np.zeros([0, 3])
+        self.tx_setid = np.zeros([0], dtype=np.int64)
+        self.rx_id = np.zeros([0], dtype=np.int64)
+        self.rx_coords = np.zeros([0, 3])
+        self.rx_setid = np.zeros([0], dtype=np.int64)
+
+        # chan_tx/chan_rx are row indexes into the node arrays, not node ids
+        self.chid = np.zeros([0], dtype=np.int64)
+        self.chan_tx = np.zeros([0], dtype=np.int64)
+        self.chan_rx = np.zeros([0], dtype=np.int64)
+        self.chan_pow = np.zeros([0])
+        self.chan_delay = np.zeros([0])
+        self.chan_ds = np.zeros([0])
+        self.chan_dist = np.zeros([0])
+        self.chan_toa = np.zeros([0])
+        self.chan_ptr = np.zeros([1], dtype=np.int64)
+
+        self.pathid = np.zeros([0], dtype=np.int64)
+        self.pow = np.zeros([0])
+        self.delay = np.zeros([0])
+        self.phase = np.zeros([0])
+        self.AoA = np.zeros([0])
+        self.EoA = np.zeros([0])
+        self.AoD = np.zeros([0])
+        self.EoD = np.zeros([0])
+        self.FSPL = np.zeros([0])
+        self.length = np.zeros([0])
+        self.nff = np.zeros([0], dtype=bool)
+        self.inter_ptr = np.zeros([1], dtype=np.int64)
+
+        # Interactions loaded with store=False keep only their count, coordinates are NaN
+        self.inter_coords = np.zeros([0, 3])
+        self.inter_typ = np.zeros([0], dtype=np.int64)
+
+    def __repr__(self):
+        return 'Columnar path storage'
+
+    def __str__(self):
+        return '{} TXs, {} RXs, {} channels, {} paths, {} interactions'.format(self.tx_id.size, self.rx_id.size,
+                                                                               self.chid.size, self.pathid.size,
+                                                                               self.inter_typ.size)
+
+    @property
+    def path_chan(self):
+        # Channel index of every path
+        return np.repeat(np.arange(self.chid.size), np.diff(self.chan_ptr))
+
+    @property
+    def path_ninters(self):
+        return np.diff(self.inter_ptr)
+
+    @property
+    def path_delay(self):
+        # Absolute delay of every path
+        return self.chan_toa.repeat(np.diff(self.chan_ptr)) + self.delay
+
+    def chan_paths(self, ci: int):
+        return slice(self.chan_ptr[ci], self.chan_ptr[ci + 1])
+
+    def path_inters(self, pi: int):
+        return slice(self.inter_ptr[pi], self.inter_ptr[pi + 1])
+
+    @staticmethod
+    def from_stor(source):
+        '''Packs Node/chan/path objects of a pairdata.data_stor into arrays.'''
+        st = path_store()
+
+        txidx = dict()
+        for i, n in enumerate(source.txs.values()):
+            txidx[n] = i
+        rxidx = dict()
+        for i, n in enumerate(source.rxs.values()):
+            rxidx[n] = i
+
+        st.tx_id = np.asarray([n.node_id for n in txidx], dtype=np.int64)
+        st.tx_coords = np.asarray([n.coords for n in txidx], dtype=float).reshape([-1, 3])
+        st.tx_setid = np.asarray([n.setid for n in txidx], dtype=np.int64)
+        st.rx_id = np.asarray([n.node_id for n in rxidx], dtype=np.int64)
+        st.rx_coords = np.asarray([n.coords for n in rxidx], dtype=float).reshape([-1, 3])
+        st.rx_setid = np.asarray([n.setid for n in rxidx], dtype=np.int64)
+
+        chans = [c for n in txidx for c in n.chans_to_pairs.values()]
+        paths = [p for c in chans for p in c.paths.values()]
+
+        st.chid = np.asarray([c.chid for c in chans], dtype=np.int64)
+        st.chan_tx = np.asarray([txidx[c.src] for c in chans], dtype=np.int64)
+        st.chan_rx = np.asarray([rxidx[c.dest] for c in chans], dtype=np.int64)
+        st.chan_pow = np.asarray([c.pow for c in chans], dtype=float)
+        st.chan_delay = np.asarray([c.delay for c in chans], dtype=float)
+        st.chan_ds = np.asarray([c.ds for c in chans], dtype=float)
+        st.chan_dist = np.asarray([c.dist for c in chans], dtype=float)
+        st.chan_toa = np.zeros([chans.__len__()])
+        st.chan_ptr = np.concatenate([[0], np.cumsum([c.paths.__len__() for c in chans])]).astype(np.int64)
+
+        st.pathid = np.asarray([p.pathid for p in paths], dtype=np.int64)
+        for i in ('pow', 'delay', 'phase', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length'):
+            setattr(st, i, np.asarray([getattr(p, i) for p in paths], dtype=float))
+        st.nff = np.asarray([p.near_field_failed for p in paths], dtype=bool)
+        st.inter_ptr = np.concatenate([[0], np.cumsum([p.interactions.__len__() for p in paths])]).astype(np.int64)
+
+        inters = [i for p in paths for i in p.interactions]
+        st.inter_coords = np.asarray([i.coords if i else [np.nan] * 3 for i in inters], dtype=float).reshape([-1, 3])
+        st.inter_typ = np.asarray([i.typ if i else -1 for i in inters], dtype=np.int64)
+
+        return st
+
+    def to_float32(self):
+        '''Narrows path and interaction columns to float32 in place.
+
+        Delays are rebased to the first arrival of their channel first, absolute delays of a few us would keep
+        only ~0.1 ns in float32.'''
+        if self.pow.dtype == np.float32:
+            return self
+
+        delay = self.path_delay
+        counts = np.diff(self.chan_ptr)
+        toa = np.zeros([self.chid.size])
+        if delay.size > 0:
+            toa[counts > 0] = np.minimum.reduceat(delay, self.chan_ptr[:-1][counts > 0])
+        self.chan_toa = toa
+        self.delay = delay - toa.repeat(counts)
+
+        for i in self.FLOAT32_COLS:
+            setattr(self, i, getattr(self, i).astype(np.float32))
+        return self
+
+    def replace_tx(self, part, tx_ids):
+        '''New store without the channels of tx_ids and with everything of part appended after the rest.
+
+        part must have been built over the same RX nodes, see data_stor.update.'''
+        st = path_store()
+        keep_tx = ~np.isin(self.tx_id, np.asarray(list(tx_ids), dtype=np.int64))
+        keep_ch = keep_tx[self.chan_tx]
+        keep_p = np.repeat(keep_ch, np.diff(self.chan_ptr))
+        keep_i = np.repeat(keep_p, np.diff(self.inter_ptr))
+
+        for i in ('tx_id', 'tx_coords', 'tx_setid'):
+            setattr(st, i, np.concatenate([getattr(self, i)[keep_tx], getattr(part, i)]))
+        for i in ('rx_id', 'rx_coords', 'rx_setid'):
+            setattr(st, i, np.array(getattr(self, i)))
+
+        # Node rows of kept channels shift down over the dropped TXs, rows of part are mapped by RX id
+        txrow = np.cumsum(keep_tx) - 1
+        order = np.argsort(self.rx_id)
+        rxrow = order[np.searchsorted(self.rx_id, part.rx_id, sorter=order)]
+        st.chan_tx = np.concatenate([txrow[self.chan_tx[keep_ch]], part.chan_tx + np.count_nonzero(keep_tx)])
+        st.chan_rx = np.concatenate([self.chan_rx[keep_ch], rxrow[part.chan_rx]])
+        for i in ('chid', 'chan_pow', 'chan_delay', 'chan_ds', 'chan_dist', 'chan_toa'):
+            setattr(st, i, np.concatenate([getattr(self, i)[keep_ch], getattr(part, i)]))
+        st.chan_ptr = np.concatenate([[0], np.cumsum(np.concatenate([np.diff(self.chan_ptr)[keep_ch],
+                                                                     np.diff(part.chan_ptr)]))]).astype(np.int64)
+
+        for i in ('pathid', 'pow', 'delay', 'phase', 'AoA', 'EoA', 'AoD', 'EoD', 'FSPL', 'length', 'nff'):
+            setattr(st, i, np.concatenate([getattr(self, i)[keep_p], getattr(part, i)]))
+        st.inter_ptr = np.concatenate([[0], np.cumsum(np.concatenate([np.diff(self.inter_ptr)[keep_p],
+                                                                      np.diff(part.inter_ptr)]))]).astype(np.int64)
+
+        for i in self.INTER_COLS:
+            setattr(st, i, np.concatenate([getattr(self, i)[keep_i], getattr(part, i)]))
+
+        return st
+
+    def save(self, dirname: str, meta: dict = None):
+        # One .npy per column, written to a private directory next to the target and renamed into place when
+        # complete, so readers only ever see whole snapshots
+        parent = os.path.dirname(os.path.abspath(dirname))
+        os.makedirs(parent, exist_ok=True)
+        tmpname = tempfile.mkdtemp(prefix=os.path.basename(dirname) + '.tmp', dir=parent)
+
+        for i in self.COLS:
+            np.save(os.path.join(tmpname, i + '.npy'), np.ascontiguousarray(getattr(self, i)))
+
+        with open(os.path.join(tmpname, 'snapshot'), mode='w') as file:
+            file.write(os.path.basename(tmpname))
+        with open(os.path.join(tmpname, 'meta.json'), mode='w') as file:
+            json.dump(meta if meta is not None else dict(), file)
+
+        # Both renames are atomic, in between the snapshot is briefly missing, which readers take as a cache miss
+        oldname = None
+        if os.path.isdir(dirname):
+            oldname = tmpname + '.old'
+            try:
+                os.rename(dirname, oldname)
+            except OSError:
+                # Moved away by another writer, or still mapped by a reader on Windows
+                oldname = None
+        try:
+            os.rename(tmpname, dirname)
+        except OSError:
+            # Another writer got there first, its snapshot is just as good
+            shutil.rmtree(tmpname, ignore_errors=True)
+        if oldname is not None:
+            # Mapped columns of the old snapshot stay readable on POSIX
+            shutil.rmtree(oldname, ignore_errors=True)
+
+    @staticmethod
+    def read_meta(dirname: str):
+        try:
+            with open(os.path.join(dirname, 'meta.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _snapshot(dirname: str):
+        with open(os.path.join(dirname, 'snapshot')) as file:
+            return file.read()
+
+    @staticmethod
+    def load(dirname: str, mmap: bool = False):
+        # With mmap the columns stay in the page cache, shared by every process that opens the same snapshot.
+        # Raises OSError when the snapshot is missing, incomplete or replaced half way through.
+        snap = path_store._snapshot(dirname)
+        st = path_store()
+        try:
+            for i in path_store.COLS:
+                setattr(st, i, np.load(os.path.join(dirname, i + '.npy'), mmap_mode='r' if mmap else None))
+        except (ValueError, EOFError) as e:
+            raise OSError('Broken cache snapshot {}: {}'.format(dirname, e))
+        if path_store._snapshot(dirname) != snap:
+            raise OSError('Cache snapshot {} was replaced while loading'.format(dirname))
+
+        # Near-field flags are written by check_data_NF, keep a private copy
+        st.nff = np.array(st.nff)
+        return st
+
+    def view(self):
+        return stor_view(self)
+
+
+class stor_view():
+    '''Read-mostly stand-in for pairdata.data_stor over a path_store, for cirs, PLPlot, chimage etc.'''
+    def __init__(self, store: path_store):
+        self.store = store
+        self.txs = dict()
+        self.rxs = dict()
+        # (tx_id, rx_id) -> chan_view
+        self.chans = dict()
+
+        txn = []
+        for i in range(store.tx_id.size):
+            n = node_view('TX', store.tx_id[i], store.tx_coords[i], store.tx_setid[i], i)
+            self.txs[n.node_id] = n
+            txn.append(n)
+
+        rxn = []
+        for i in range(store.rx_id.size):
+            n = node_view('RX', store.rx_id[i], store.rx_coords[i], store.rx_setid[i], i)
+            self.rxs[n.node_id] = n
+            rxn.append(n)
+
+        for i in range(store.chid.size):
+            src = txn[store.chan_tx[i]]
+            dest = rxn[store.chan_rx[i]]
+            c = chan_view(store, i, src, dest)
+            src.chans_to_pairs[dest] = c
+            dest.chans_to_pairs[src] = c
+            self.chans[(src.node_id, dest.node_id)] = c
+
+    def __repr__(self):
+        return 'Columnar data storage view'
+
+    def get_chan(self, tx: int, rx: int):
+        return self.chans.get((tx, rx))
+
+    def __str__(self):
+        return str(self.store)
+
+
+class node_view():
+    def __init__(self, typ: str, node_id: int, coords, setid: int, row: int):
+        self.chans_to_pairs = dict()
+        self.node_id = int(node_id)
+        self.coords = coords
+        # Index into store.tx_coords/rx_coords, same as pairdata.Node.row
+        self.row = row
+        self.rot = np.zeros([3])
+        self.setid = int(setid)
+        self.type = typ
+
+    def chan_to(self, dest):
+        return self.chans_to_pairs.get(dest)
+
+
+class chan_view():
+    def __init__(self, store: path_store, idx: int, src: node_view, dest: node_view):
+        self.store = store
+        self.idx = idx
+        self.src = src
+        self.dest = dest
+        self.clusters = dict()
+        self._paths = None
+
+    def __repr__(self):
+        return 'Radio channel'
+
+    @property
+    def chid(self):
+        return int(self.store.chid[self.idx])
+
+    @property
+    def pow(self):
+        return float(self.store.chan_pow[self.idx])
+
+    @property
+    def delay(self):
+        return float(self.store.chan_delay[self.idx])
+
+    @property
+    def ds(self):
+        return float(self.store.chan_ds[self.idx])
+
+    @property
+    def dist(self):
+        return float(self.store.chan_dist[self.idx])
+
+    @property
+    def paths(self):
+        # Built on first access and kept, per-path state such as cluster must survive between accesses
+        if self._paths is None:
+            self._paths = dict()
+            for i in range(self.store.chan_ptr[self.idx], self.store.chan_ptr[self.idx + 1]):
+                self._paths[int(self.store.pathid[i])] = path_view(self.store, i, self)
+        return self._paths
+
+
+class path_view():
+    def __init__(self, store: path_store, idx: int, chan: chan_view):
+        self.store = store
+        self.idx = idx
+        self.chan = chan
+        self.cluster = None
+
+    def __repr__(self):
+        return 'Propagation path'
+
+    @property
+    def pathid(self):
+        return int(self.store.pathid[self.idx])
+
+    @property
+    def pow(self):
+        return float(self.store.pow[self.idx])
+
+    @property
+    def delay(self):
+        return float(self.store.chan_toa[self.chan.idx] + self.store.delay[self.idx])
+
+    @property
+    def phase(self):
+        return float(self.store.phase[self.idx])
+
+    @property
+    def AoA(self):
+        return float(self.store.AoA[self.idx])
+
+    @property
+    def EoA(self):
+        return float(self.store.EoA[self.idx])
+
+    @property
+    def AoD(self):
+        return float(self.store.AoD[self.idx])
+
+    @property
+    def EoD(self):
+        return float(self.store.EoD[self.idx])
+
+    @property
+    def FSPL(self):
+        return float(self.store.FSPL[self.idx])
+
+    @property
+    def length(self):
+        return float(self.store.length[self.idx])
+
+    @property
+    def near_field_failed(self):
+        return bool(self.store.nff[self.idx])
+
+    @near_field_failed.setter
+    def near_field_failed(self, val: bool):
+        self.store.nff[self.idx] = val
+
+    @property
+    def interactions(self):
+        inters = []
+        for i in range(self.store.inter_ptr[self.idx], self.store.inter_ptr[self.idx + 1]):
+            if self.store.inter_typ[i] < 0:
+                inters.append(False)
+            else:
+                inters.append(inter_view(self.store, i, self))
+        return inters
+
+
+class inter_view():
+    def __init__(self, store: path_store, idx: int, path: path_view):
+        self.typ = int(store.inter_typ[idx])
+        self.coords = store.inter_coords[idx]
+        self.path = path
+
+    def __repr__(self):
+        return 'Interaction'
@@ -17,6 +17,7 @@ import matplotlib.pyplot as mpl
 import scipy.io as sio
 import pairdata
 from phys_path_procs import *
+from auxclass import SpillDir
 
 
 class PLPlot:
@@ -33,66 +34,72 @@ class PLPlot:
         self.mean_res = 0.0
         self.var_res = np.PINF
 
-    def regr_comp(self, rxgrp: list = [-1], txgrp: list = [-1], typ: str ='LOS', threshold: float = -130, nff: bool = True):
-        self.xdata = []
-        self.ydata = []
+    def regr_comp(self, rxgrp: list = [-1], txgrp: list = [-1], typ: str ='LOS', threshold: float = -130, nff: bool = True,
+                  stream: bool = False, batch: int = 16, chunked: bool = False, spill_dir: str = None,
+                  freq: float = 60e9):
         self.typ = typ
         self.thrshld = threshold
 
         txgrp = [txgrp] if not isinstance(txgrp, list) else txgrp
         rxgrp = [rxgrp] if not isinstance(rxgrp, list) else rxgrp
 
-        # Prepare data for making the regression
-        for i in self.source.txs.items():
-            # TX is in valid group or group is ignored?
-            if i[1].setid in txgrp or txgrp[0] == -1:
-                # Which RXes are reached by TX
-                for j in i[1].chans_to_pairs.items():
-                    # Destination in a valid group or group is ignored?
-                    if j[0].setid in rxgrp or rxgrp[0] == -1:
-                        # Check paths for the RX-TX, only pick valid ones
-                        for k in j[1].paths.items():
-                            if nff and not k[1].near_field_failed:
-                                if k[1].interactions.__len__() == 0 and typ == 'LOS' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() == 1 and typ == 'NLOS-1' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() == 2 and typ == 'NLOS-2' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() >= 1 and typ == 'NLOS' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                            elif not nff:
-                                if k[1].interactions.__len__() == 0 and typ == 'LOS' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() == 1 and typ == 'NLOS-1' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() == 2 and typ == 'NLOS-2' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-                                elif k[1].interactions.__len__() >= 1 and typ == 'NLOS' and l2db(k[1].pow) >= self.thrshld:
-                                    self.xdata.append(np.log10(j[1].dist))
-                                    self.ydata.append(k[1].FSPL)
-                                    self.nsamps += 1
-
-        self.xdata = np.asarray(self.xdata)
-        self.ydata = np.asarray(self.ydata)
+        if chunked:
+            # Out of core: regression sums stay in memory, samples are spilled per chunk of TXs
+            spill = SpillDir(spill_dir)
+            # n, sum(x), sum(y), sum(x^2), sum(xy)
+            sums = np.zeros([5])
+            for chans in self.source.iter_chunks(txgrp, rxgrp, chunk=batch, nff=nff, freq=freq):
+                x, y = self._samples(chans, nff)
+                sums += [x.size, np.sum(x), np.sum(y), np.sum(x * x), np.sum(x * y)]
+                spill.save(x=x, y=y)
+
+            self.xdata = spill.concat('x')
+            self.ydata = spill.concat('y')
+            spill.close()
+            self.nsamps += int(sums[0])
+            # Normal equations of the ax + b fit, lstsq gives the same answer as the in-memory fit when they are
+            # singular (no samples, or all at one distance)
+            self.a, self.b = np.linalg.lstsq([[sums[3], sums[1]], [sums[1], sums[0]]], [sums[4], sums[2]], rcond=None)[0]
+            return self.a, self.b
+
+        if stream:
+            # One pass straight from the DB, nothing has to be loaded but the nodes. Streamed channels never went
+            # through check_data_NF, the NF test at freq is run on them while streaming.
+            chans = self.source.iter_channels(txgrp, rxgrp, batch=batch, nff=nff, freq=freq)
+        else:
+            # TX and destination in a valid group or group is ignored?
+            chans = (j[1] for i in self.source.txs.items() if i[1].setid in txgrp or txgrp[0] == -1
+                     for j in i[1].chans_to_pairs.items() if j[0].setid in rxgrp or rxgrp[0] == -1)
+
+        self.xdata, self.ydata = self._samples(chans, nff)
+        self.nsamps += self.xdata.size
         # Data ready, calculate ax + b regression
         self.a, self.b = np.linalg.lstsq(np.vstack([self.xdata, np.ones(self.xdata.__len__())]).T, self.ydata, rcond=None)[0]
         return self.a, self.b
 
+    def _samples(self, chans, nff: bool):
+        xdata = []
+        ydata = []
+        # Prepare data for making the regression
+        for j in chans:
+            # Check paths for the RX-TX, only pick valid ones
+            for k in j.paths.items():
+                if nff and not k[1].near_field_failed or not nff:
+                    if k[1].interactions.__len__() == 0 and self.typ == 'LOS' and l2db(k[1].pow) >= self.thrshld:
+                        xdata.append(np.log10(j.dist))
+                        ydata.append(k[1].FSPL)
+                    elif k[1].interactions.__len__() == 1 and self.typ == 'NLOS-1' and l2db(k[1].pow) >= self.thrshld:
+                        xdata.append(np.log10(j.dist))
+                        ydata.append(k[1].FSPL)
+                    elif k[1].interactions.__len__() == 2 and self.typ == 'NLOS-2' and l2db(k[1].pow) >= self.thrshld:
+                        xdata.append(np.log10(j.dist))
+                        ydata.append(k[1].FSPL)
+                    elif k[1].interactions.__len__() >= 1 and self.typ == 'NLOS' and l2db(k[1].pow) >= self.thrshld:
+                        xdata.append(np.log10(j.dist))
+                        ydata.append(k[1].FSPL)
+
+        return np.asarray(xdata, dtype=float), np.asarray(ydata, dtype=float)
+
     def export(self, plot: bool = True, csvsav: bool = False, matsav: bool = False):
         self.mean_res = np.mean(self.ydata - self.b - self.a * self.xdata)
         self.var_res = np.sqrt(np.var(self.ydata - self.b - self.a * self.xdata))
@@ -124,9 +131,7 @@ class PLPlot:
 
 if __name__ == '__main__':
     DS = pairdata.data_stor(conf='dbconf.txt')
-    DS.load_rxtx('Human_sitting_legsback_Sitting_sqlite')
-    DS.load_paths()
-    DS.load_interactions()
+    DS.load('Human_sitting_legsback_Sitting_sqlite', mmap=True)
     check_data_NF(DS)
     plp = PLPlot(source=DS)
     print(plp.regr_comp(typ='LOS', threshold=-115, nff=True))
@@ -20,12 +20,19 @@ TX_EXTR = 'SELECT tx_id, x, y, z, tx_set_id FROM tx;'
 
 RX_EXTR = 'SELECT rx_id, x, y, z, rx_set_id FROM rx;'
 
+TX_EXTR_GRP = 'SELECT tx_id, x, y, z, tx_set_id FROM tx WHERE tx_set_id IN ({});'
+
+RX_EXTR_GRP = 'SELECT rx_id, x, y, z, rx_set_id FROM rx WHERE rx_set_id IN ({});'
+
+# Queries with {chcond}, {pcond} and {icond} fields take extra filters on the channel, path_utd and interaction
+# tables respectively, pass '' to leave them out
+
 TX_PAIRS = 'SELECT * FROM (SELECT channel_utd.channel_id, channel_utd.received_power, ' \
            'channel_utd.mean_time_of_arrival, channel_utd.delay_spread ' \
            'FROM channel_utd WHERE channel_utd.channel_id IN ' \
            '(SELECT channel_id FROM channel WHERE tx_id = {})) utd ' \
            'JOIN ' \
-           '(SELECT channel.channel_id ,channel.rx_id FROM channel WHERE tx_id = {}) chan ' \
+           '(SELECT channel.channel_id ,channel.rx_id FROM channel WHERE tx_id = {}{chcond}) chan ' \
            'ON utd.channel_id = chan.channel_id;'
 
 TX_PAIRST = 'SELECT * FROM (SELECT channel_utd.channel_id, channel_utd.received_power, ' \
@@ -33,7 +40,7 @@ TX_PAIRST = 'SELECT * FROM (SELECT channel_utd.channel_id, channel_utd.received_
            'FROM channel_utd WHERE channel_utd.channel_id IN ' \
            '(SELECT channel_id FROM channel WHERE tx_id BETWEEN {} AND {})) utd ' \
            'JOIN ' \
-           '(SELECT channel.channel_id ,channel.rx_id, channel.tx_id FROM channel WHERE tx_id BETWEEN {} AND {}) chan ' \
+           '(SELECT channel.channel_id ,channel.rx_id, channel.tx_id FROM channel WHERE tx_id BETWEEN {} AND {}{chcond}) chan ' \
            'ON utd.channel_id = chan.channel_id;'
 
 RX_PAIRST = 'SELECT * FROM (SELECT channel_utd.channel_id, channel_utd.received_power, ' \
@@ -41,16 +48,113 @@ RX_PAIRST = 'SELECT * FROM (SELECT channel_utd.channel_id, channel_utd.received_
            'FROM channel_utd WHERE channel_utd.channel_id IN ' \
            '(SELECT channel_id FROM channel WHERE rx_id BETWEEN {} AND {})) utd ' \
            'JOIN ' \
-           '(SELECT channel.channel_id ,channel.tx_id, channel.rx_id FROM channel WHERE rx_id BETWEEN {} AND {}) chan ' \
+           '(SELECT channel.channel_id ,channel.tx_id, channel.rx_id FROM channel WHERE rx_id BETWEEN {} AND {}{chcond}) chan ' \
            'ON utd.channel_id = chan.channel_id;'
 
+# Channels of an explicit list of TX/RX ids, same columns as TX_PAIRST/RX_PAIRST
+TX_PAIRSIN = 'SELECT channel_utd.channel_id, channel_utd.received_power, channel_utd.mean_time_of_arrival,' \
+             ' channel_utd.delay_spread, channel.channel_id, channel.rx_id, channel.tx_id FROM channel_utd' \
+             ' JOIN channel ON channel_utd.channel_id = channel.channel_id WHERE channel.tx_id IN ({}){chcond};'
+
+RX_PAIRSIN = 'SELECT channel_utd.channel_id, channel_utd.received_power, channel_utd.mean_time_of_arrival,' \
+             ' channel_utd.delay_spread, channel.channel_id, channel.tx_id, channel.rx_id FROM channel_utd' \
+             ' JOIN channel ON channel_utd.channel_id = channel.channel_id WHERE channel.rx_id IN ({}){chcond};'
+
+# Paths per TX/RX, used to weight work batches before loading
+TX_PATH_COUNT = 'SELECT channel.tx_id, COUNT(*) FROM path JOIN channel ON path.channel_id = channel.channel_id' \
+                ' WHERE channel.tx_id IS NOT NULL{chcond} GROUP BY channel.tx_id;'
+
+RX_PATH_COUNT = 'SELECT channel.rx_id, COUNT(*) FROM path JOIN channel ON path.channel_id = channel.channel_id' \
+                ' WHERE channel.rx_id IS NOT NULL{chcond} GROUP BY channel.rx_id;'
+
+# Channel/path counts and highest ids per TX, any re-simulated or re-uploaded TX changes at least one of them
+TX_STATE = 'SELECT channel.tx_id, COUNT(channel.channel_id), MAX(channel.channel_id), SUM(pth.npath), MAX(pth.maxid),' \
+           ' SUM(chu.pow), SUM(pth.pow) FROM channel' \
+           ' LEFT JOIN (SELECT channel_id, SUM(received_power) AS pow FROM channel_utd GROUP BY channel_id) AS chu' \
+           ' ON chu.channel_id = channel.channel_id' \
+           ' LEFT JOIN (SELECT path.channel_id, COUNT(DISTINCT path.path_id) AS npath, MAX(path.path_id) AS maxid,' \
+           ' SUM(path_utd.received_power) AS pow FROM path LEFT JOIN path_utd ON path_utd.path_id = path.path_id' \
+           ' GROUP BY path.channel_id) AS pth ON pth.channel_id = channel.channel_id' \
+           ' WHERE channel.tx_id IS NOT NULL{chcond} GROUP BY channel.tx_id;'
+
 CHAN_PTH = 'SELECT path_utd_id, received_power, time_of_arrival, departure_phi, departure_theta, arrival_phi,' \
            ' arrival_theta, freespace_path_loss, cir_phs FROM path_utd WHERE path_id IN (SELECT path_id FROM' \
            ' path WHERE channel_id = {});'
 
+CHAN_PTH_TOP = 'SELECT path_utd_id, received_power, time_of_arrival, departure_phi, departure_theta, arrival_phi,' \
+               ' arrival_theta, freespace_path_loss, cir_phs FROM path_utd WHERE path_id IN (SELECT path_id FROM' \
+               ' path WHERE channel_id = {}){pcond} ORDER BY received_power DESC LIMIT {};'
+
 INTERS = 'SELECT * FROM interaction_type;'
 
+TABLE_ROWS = 'SELECT COUNT(*) FROM {};'
+
 INTERS_SPEC_CHAN = 'SELECT x, y, z, interaction_type_id, path_id FROM interaction WHERE path_id IN' \
                    '(SELECT path_id FROM path WHERE channel_id = {});'
 
-INTERS_SPEC = 'SELECT x,y,z,interaction_type_id FROM interaction WHERE path_id = {};'
\ No newline at end of file
+INTERS_SPEC = 'SELECT x,y,z,interaction_type_id FROM interaction WHERE path_id = {};'
+
+# Paths/interactions of an explicit list of TX or RX ids, one query per work batch
+TX_RANGE_PTH = 'SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power, path_utd.time_of_arrival,' \
+               ' path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi, path_utd.arrival_theta,' \
+               ' path_utd.freespace_path_loss, path_utd.cir_phs FROM path_utd' \
+               ' JOIN path ON path_utd.path_id = path.path_id' \
+               ' JOIN channel ON path.channel_id = channel.channel_id' \
+               ' WHERE channel.tx_id IN ({}){chcond}{pcond};'
+
+RX_RANGE_PTH = 'SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power, path_utd.time_of_arrival,' \
+               ' path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi, path_utd.arrival_theta,' \
+               ' path_utd.freespace_path_loss, path_utd.cir_phs FROM path_utd' \
+               ' JOIN path ON path_utd.path_id = path.path_id' \
+               ' JOIN channel ON path.channel_id = channel.channel_id' \
+               ' WHERE channel.rx_id IN ({}){chcond}{pcond};'
+
+# Same as above, but only the npaths strongest paths of every channel (needs window functions)
+TX_RANGE_PTH_TOP = 'SELECT * FROM (SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power,' \
+                   ' path_utd.time_of_arrival, path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi,' \
+                   ' path_utd.arrival_theta, path_utd.freespace_path_loss, path_utd.cir_phs,' \
+                   ' ROW_NUMBER() OVER (PARTITION BY path.channel_id ORDER BY path_utd.received_power DESC) AS pth_rank' \
+                   ' FROM path_utd JOIN path ON path_utd.path_id = path.path_id' \
+                   ' JOIN channel ON path.channel_id = channel.channel_id' \
+                   ' WHERE channel.tx_id IN ({}){chcond}{pcond}) ranked WHERE pth_rank <= {};'
+
+RX_RANGE_PTH_TOP = 'SELECT * FROM (SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power,' \
+                   ' path_utd.time_of_arrival, path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi,' \
+                   ' path_utd.arrival_theta, path_utd.freespace_path_loss, path_utd.cir_phs,' \
+                   ' ROW_NUMBER() OVER (PARTITION BY path.channel_id ORDER BY path_utd.received_power DESC) AS pth_rank' \
+                   ' FROM path_utd JOIN path ON path_utd.path_id = path.path_id' \
+                   ' JOIN channel ON path.channel_id = channel.channel_id' \
+                   ' WHERE channel.rx_id IN ({}){chcond}{pcond}) ranked WHERE pth_rank <= {};'
+
+TX_RANGE_INTERS = 'SELECT interaction.path_id, interaction.x, interaction.y, interaction.z,' \
+                  ' interaction.interaction_type_id FROM interaction' \
+                  ' JOIN path ON interaction.path_id = path.path_id' \
+                  ' JOIN channel ON path.channel_id = channel.channel_id' \
+                  ' WHERE channel.tx_id IN ({}){chcond}{icond}' \
+                  ' ORDER BY interaction.path_id, interaction.interaction_id;'
+
+RX_RANGE_INTERS = 'SELECT interaction.path_id, interaction.x, interaction.y, interaction.z,' \
+                  ' interaction.interaction_type_id FROM interaction' \
+                  ' JOIN path ON interaction.path_id = path.path_id' \
+                  ' JOIN channel ON path.channel_id = channel.channel_id' \
+                  ' WHERE channel.rx_id IN ({}){chcond}{icond}' \
+                  ' ORDER BY interaction.path_id, interaction.interaction_id;'
+
+# Paths/interactions of an explicit list of channels, used for lazy loading
+CHANS_PTH = 'SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power, path_utd.time_of_arrival,' \
+            ' path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi, path_utd.arrival_theta,' \
+            ' path_utd.freespace_path_loss, path_utd.cir_phs FROM path_utd' \
+            ' JOIN path ON path_utd.path_id = path.path_id' \
+            ' WHERE path.channel_id IN ({}){pcond};'
+
+CHANS_PTH_TOP = 'SELECT * FROM (SELECT path.channel_id, path_utd.path_utd_id, path_utd.received_power,' \
+                ' path_utd.time_of_arrival, path_utd.departure_phi, path_utd.departure_theta, path_utd.arrival_phi,' \
+                ' path_utd.arrival_theta, path_utd.freespace_path_loss, path_utd.cir_phs,' \
+                ' ROW_NUMBER() OVER (PARTITION BY path.channel_id ORDER BY path_utd.received_power DESC) AS pth_rank' \
+                ' FROM path_utd JOIN path ON path_utd.path_id = path.path_id' \
+                ' WHERE path.channel_id IN ({}){pcond}) ranked WHERE pth_rank <= {};'
+
+CHANS_INTERS = 'SELECT interaction.path_id, interaction.x, interaction.y, interaction.z,' \
+               ' interaction.interaction_type_id FROM interaction' \
+               ' JOIN path ON interaction.path_id = path.path_id' \
+               ' WHERE path.channel_id IN ({}){icond} ORDER BY interaction.path_id, interaction.interaction_id;'
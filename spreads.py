@@ -11,7 +11,7 @@ class DelaySpreadHist:
         self.binrange = brange
 
     def export(self, rxgrp: list = [-1], txgrp: list = [-1], xlims: tuple = (0, 10), ylims: tuple = (0, 10), figdims: tuple = (640, 480),
-               mkpng: bool = False, matsav: bool = False, plot: bool = True):
+               mkpng: bool = False, matsav: bool = False, plot: bool = True, stream: bool = False, batch: int = 16):
 
         rms_hist = PowHist(binc=self.binc, rstart=self.binrange[0], rstop=self.binrange[1])
         simple_hist = PowHist(binc=self.binc, rstart=self.binrange[0], rstop=self.binrange[1])
@@ -20,21 +20,23 @@ class DelaySpreadHist:
             fig = mpl.figure()
             fig.show()
 
-        for i in self.source.txs.items():
-            # TX is in valid group or group is ignored?
-            if i[1].setid in txgrp or txgrp[0] == -1:
-                # Which RXes are reached by TX
-                for j in i[1].chans_to_pairs.items():
-                    # Destination in a valid group or group is ignored?
-                    if j[0].setid in rxgrp or rxgrp[0] == -1:
-                        delay_vector = []
-                        for k in j[1].paths.items():
-                            delay_vector.append(k[1].delay)
-                        simple = np.max(delay_vector) - np.min(delay_vector)
-                        rms = np.sqrt(1/len(delay_vector) * (np.sum([d**2 for d in delay_vector])))
-                        print('Simple: {} | RMS: {} | Dist: {}'.format(simple, rms, j[1].dist))
-                        rms_hist.append(j[1].dist, rms)
-                        rms_hist.append(j[1].dist, simple)
+        if stream:
+            # One pass straight from the DB, nothing has to be loaded but the nodes
+            chans = self.source.iter_channels(txgrp, rxgrp, batch=batch)
+        else:
+            # TX and destination in a valid group or group is ignored?
+            chans = (j[1] for i in self.source.txs.items() if i[1].setid in txgrp or txgrp[0] == -1
+                     for j in i[1].chans_to_pairs.items() if j[0].setid in rxgrp or rxgrp[0] == -1)
+
+        for j in chans:
+            delay_vector = []
+            for k in j.paths.items():
+                delay_vector.append(k[1].delay)
+            simple = np.max(delay_vector) - np.min(delay_vector)
+            rms = np.sqrt(1/len(delay_vector) * (np.sum([d**2 for d in delay_vector])))
+            print('Simple: {} | RMS: {} | Dist: {}'.format(simple, rms, j.dist))
+            rms_hist.append(j.dist, rms)
+            rms_hist.append(j.dist, simple)
 
 
 